@@ -1,6 +1,9 @@
 #include <string.h> // for basename(3) that doesn't modify its argument
 #include <unistd.h> // for getopt
+#include <cstdlib>  // for getenv
+#include <iomanip>  // for setprecision
 #include <sstream>
+#include <vector>
 
 #include "cam_properties.hpp"
 
@@ -32,6 +35,74 @@ json jsonify_tag(nvAprilTagsID_t detection)
     return j;
 }
 
+// seconds on the monotonic clock, the same clock as Python's time.monotonic(),
+// so latency traces can be compared across processes
+double monotonic_seconds()
+{
+    return std::chrono::duration<double>(std::chrono::steady_clock::now().time_since_epoch()).count();
+}
+
+// binary encoding of a frame of detections, must match apriltag_codec.py.
+// little endian and packed, a header followed by one record per tag
+#pragma pack(push, 1)
+struct BinaryHeader
+{
+    char magic[4];
+    uint16_t version;
+    uint16_t count;
+    uint32_t seq;
+    uint32_t reserved;
+    double timestamp; // capture time
+    double detected;
+    double published;
+};
+
+struct BinaryTag
+{
+    int32_t id;
+    float pos[3];
+    float rotation[9]; // row-major
+};
+#pragma pack(pop)
+
+std::vector<char> pack_tags(const nvAprilTagsID_t *detections, uint32_t num_detections, uint32_t seq, double timestamp, double detected)
+{
+    std::vector<char> payload(sizeof(BinaryHeader) + num_detections * sizeof(BinaryTag));
+
+    BinaryHeader *header = reinterpret_cast<BinaryHeader *>(payload.data());
+    memcpy(header->magic, "ATAG", 4);
+    header->version = 2;
+    header->count = num_detections;
+    header->seq = seq;
+    header->reserved = 0;
+    header->timestamp = timestamp;
+    header->detected = detected;
+
+    BinaryTag *tags = reinterpret_cast<BinaryTag *>(payload.data() + sizeof(BinaryHeader));
+    for (uint32_t i = 0; i < num_detections; i++)
+    {
+        const nvAprilTagsID_t &detection = detections[i];
+        tags[i].id = detection.id;
+
+        for (int k = 0; k < 3; k++)
+        {
+            tags[i].pos[k] = detection.translation[k];
+        }
+
+        // the orientation is column-major, same transpose as jsonify_tag
+        for (int row = 0; row < 3; row++)
+        {
+            for (int col = 0; col < 3; col++)
+            {
+                tags[i].rotation[row * 3 + col] = detection.orientation[col * 3 + row];
+            }
+        }
+    }
+
+    header->published = monotonic_seconds();
+    return payload;
+}
+
 int main()
 {
     //############################################# SETUP MQTT ####################################################################################
@@ -39,6 +110,12 @@ int main()
     const std::string CLIENT_ID{"nvapriltags"};
     const std::string TAG_TOPIC{"avr/apriltags/raw"};
     const std::string FPS_TOPIC{"avr/apriltags/fps"};
+    const std::string BINARY_TAG_TOPIC{"avr/apriltags/raw/binary"};
+
+    // APRILTAG_ENCODING=binary publishes packed detections instead of JSON
+    const char *encoding = std::getenv("APRILTAG_ENCODING");
+    const bool binary = encoding != nullptr && std::string(encoding) == "binary";
+    uint32_t seq = 0;
 
     const int QOS = 0;
     mqtt::client client(SERVER_ADDRESS, CLIENT_ID);
@@ -87,6 +164,7 @@ int main()
 
         //capture a frame
         bool result = capture.read(frame);
+        double capture_time = monotonic_seconds();
         if (result)
         {
             //undistort it
@@ -97,33 +175,48 @@ int main()
 
             //send the frame to GPU memory and run the detections
             uint32_t num_detections = process_frame(img_rgba8, impl_);
+            double detected_time = monotonic_seconds();
+            seq++;
 
-            std::string payload = "{\"tags\":[";
-
-            //handle the detections
-            for (int i = 0; i < num_detections; i++)
+            if (binary)
             {
-                const nvAprilTagsID_t &detection = impl_->tags[i];
-
-                json j = jsonify_tag(detection);
-
-                payload.append(j.dump());
-                if (i < num_detections - 1)
+                if (num_detections > 0)
                 {
-                    payload.append(",");
+                    std::vector<char> binary_payload = pack_tags(impl_->tags.data(), num_detections, seq, capture_time, detected_time);
+                    client.publish(BINARY_TAG_TOPIC, binary_payload.data(), binary_payload.size());
                 }
             }
+            else if (num_detections > 0)
+            {
+                std::string payload = "{\"tags\":[";
 
-            payload.append("]}");
+                //handle the detections
+                for (int i = 0; i < num_detections; i++)
+                {
+                    const nvAprilTagsID_t &detection = impl_->tags[i];
 
-            auto end = std::chrono::system_clock::now();
+                    json j = jsonify_tag(detection);
+
+                    payload.append(j.dump());
+                    if (i < num_detections - 1)
+                    {
+                        payload.append(",");
+                    }
+                }
+
+                // latency trace of this frame, see latency_tracer.py. Written by
+                // hand as the json type above only has single precision floats
+                std::ostringstream trace;
+                trace << std::fixed << std::setprecision(6);
+                trace << "],\"trace\":{\"seq\":" << seq << ",\"capture\":" << capture_time << ",\"detected\":" << detected_time << ",\"published\":" << monotonic_seconds() << "}}";
+                payload.append(trace.str());
 
-            if (num_detections > 0)
-            {
                 const char *const_payload = payload.c_str();
                 client.publish(TAG_TOPIC, const_payload, strlen(const_payload));
             }
 
+            auto end = std::chrono::system_clock::now();
+
             int fps = int(1000 / (std::chrono::duration_cast<std::chrono::milliseconds>(end - start).count() + 1));
 
             std::string fps_str = "{\"fps\": " + std::to_string(fps) + "}";
@@ -0,0 +1,255 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+from cpu_apriltag_library import AprilTagWrapper
+from frame_recorder import FrameReader, is_recording
+from loguru import logger
+from rectify import AVR_CAMERA_PARAMS
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".pgm")
+RAW_EXTENSIONS = (".raw", ".bin", ".gray")
+
+
+def iter_image_dir(path: str) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Yields every image in a directory as grayscale, in filename order
+    """
+    for name in sorted(os.listdir(path)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+
+        img = cv2.imread(os.path.join(path, name), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            logger.warning(f"Could not read {name}, skipping")
+            continue
+
+        yield name, img
+
+
+def iter_video(path: str) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Yields every frame of a video file as grayscale, named by frame index
+    """
+    cap = cv2.VideoCapture(path)
+    index = 0
+
+    while True:
+        ret, img = cap.read()
+        if not ret:
+            break
+
+        yield str(index), cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        index += 1
+
+    cap.release()
+
+
+def iter_raw_frames(path: str, width: int, height: int) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Yields zero-copy views into a memory-mapped file of back to back 8-bit
+    grayscale frames, named by frame index
+    """
+    frames = np.memmap(path, dtype=np.uint8, mode="r")
+    frames = frames[: frames.size - frames.size % (width * height)].reshape(-1, height, width)
+
+    for index, img in enumerate(frames):
+        yield str(index), img
+
+
+def iter_recording(path: str) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Yields zero-copy views of the frames in a `FrameRecorder` recording, named by
+    frame index
+    """
+    for index, img in enumerate(FrameReader(path)):
+        yield str(index), img
+
+
+def load_frames(source: str, width: Optional[int] = None, height: Optional[int] = None) -> List[Tuple[str, np.ndarray]]:
+    """
+    Loads every frame from a directory of images, a frame recording, a raw frame
+    file, or a video file, so that decoding is not counted in the benchmark.
+    """
+    if os.path.isdir(source):
+        return list(iter_image_dir(source))
+
+    if is_recording(source):
+        return list(iter_recording(source))
+
+    if source.lower().endswith(RAW_EXTENSIONS):
+        if width is None or height is None:
+            raise ValueError("Raw frame files need --width and --height")
+        return list(iter_raw_frames(source, width, height))
+
+    return list(iter_video(source))
+
+
+def rotation_error_deg(R_est: np.ndarray, R_truth: np.ndarray) -> float:
+    """
+    Returns the angle of the rotation between two rotation matrices, in degrees
+    """
+    cos = (np.trace(np.asarray(R_est).T @ np.asarray(R_truth)) - 1) / 2
+    return float(np.degrees(np.arccos(np.clip(cos, -1.0, 1.0))))
+
+
+def summarize(values: Sequence[float], prefix: str) -> Dict[str, Optional[float]]:
+    """
+    Returns the mean, 50th, 90th and 99th percentile, and maximum of a list of values
+    """
+    if not values:
+        return {f"{prefix}_{stat}": None for stat in ("mean", "p50", "p90", "p99", "max")}
+
+    arr = np.asarray(values, dtype=float)
+    p50, p90, p99 = np.percentile(arr, [50, 90, 99])
+    return {
+        f"{prefix}_mean": float(arr.mean()),
+        f"{prefix}_p50": float(p50),
+        f"{prefix}_p90": float(p90),
+        f"{prefix}_p99": float(p99),
+        f"{prefix}_max": float(arr.max()),
+    }
+
+
+def benchmark(
+    frames: List[Tuple[str, np.ndarray]],
+    camera_params: Tuple[float, float, float, float],
+    tag_size: float,
+    detector_params: Dict[str, Any],
+    truth: Optional[Dict[str, List[dict]]] = None,
+) -> Dict[str, Any]:
+    """
+    Runs a single detector configuration over every frame, and measures
+    throughput, per-frame latency, and (if labeled ground truth is given)
+    detection recall, false positives, and pose error.
+
+    Ground truth maps a frame name to a list of `{"id": int}` tags, which may also
+    have a `"pos"` [x, y, z] in meters and a `"rotation"` 3x3 matrix.
+    """
+    atag = AprilTagWrapper(camera_params, tag_size, detector_params)
+    detector_params = atag.detector_params
+
+    # warm up the detector's thread pool and buffers
+    atag.process_image(frames[0][1])  # type: ignore
+
+    latencies = []
+    num_truth = 0
+    num_found = 0
+    num_false = 0
+    pos_errors = []
+    rot_errors = []
+    total_start = time.perf_counter()
+
+    for name, img in frames:
+        start = time.perf_counter()
+        tags = atag.process_image(img)  # type: ignore
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        if truth is None or name not in truth:
+            continue
+
+        detected = {tag.tag_id: tag for tag in tags}
+        expected = {label["id"]: label for label in truth[name]}
+        num_truth += len(expected)
+        num_false += len(detected.keys() - expected.keys())
+
+        for tag_id, label in expected.items():
+            if tag_id not in detected:
+                continue
+
+            num_found += 1
+            tag = detected[tag_id]
+            if "pos" in label:
+                pos_errors.append(float(np.linalg.norm(np.asarray(tag.pose_t).ravel() - np.asarray(label["pos"], dtype=float))))
+            if "rotation" in label:
+                rot_errors.append(rotation_error_deg(tag.pose_R, label["rotation"]))
+
+    total = time.perf_counter() - total_start
+
+    result: Dict[str, Any] = {
+        "quad_decimate": detector_params["quad_decimate"],
+        "nthreads": detector_params["nthreads"],
+        "refine_edges": detector_params["refine_edges"],
+        "frames": len(frames),
+        "fps": len(frames) / total if total > 0 else None,
+    }
+    result.update(summarize(latencies, "latency_ms"))
+    result["recall"] = num_found / num_truth if num_truth else None
+    result["false_positives"] = num_false if truth is not None else None
+    result.update(summarize(pos_errors, "pos_error_m"))
+    result.update(summarize(rot_errors, "rot_error_deg"))
+
+    return result
+
+
+def sweep(
+    frames: List[Tuple[str, np.ndarray]],
+    camera_params: Tuple[float, float, float, float],
+    tag_size: float,
+    quad_decimate: Sequence[float],
+    nthreads: Sequence[int],
+    refine_edges: Sequence[int],
+    truth: Optional[Dict[str, List[dict]]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Benchmarks every combination of the given detector parameters.
+    """
+    results = []
+
+    for decimate, threads, refine in itertools.product(quad_decimate, nthreads, refine_edges):
+        params = {"quad_decimate": decimate, "nthreads": threads, "refine_edges": refine}
+        result = benchmark(frames, camera_params, tag_size, params, truth)
+        results.append(result)
+
+        recall = "n/a" if result["recall"] is None else f"{result['recall']:.1%}"
+        logger.info(
+            f"quad_decimate={decimate} nthreads={threads} refine_edges={refine}: {result['fps']:.1f} fps, p50 {result['latency_ms_p50']:.2f} ms, p99 {result['latency_ms_p99']:.2f} ms, recall {recall}"
+        )
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the CPU AprilTag detector on recorded frames")
+    parser.add_argument("source", type=str, help="Directory of images, video file, frame recording, or raw frame file")
+    parser.add_argument("--width", type=int, help="Frame width, required for raw frame files")
+    parser.add_argument("--height", type=int, help="Frame height, required for raw frame files")
+    parser.add_argument("--truth", type=str, help="JSON file mapping frame names to labeled tags")
+    parser.add_argument("--camera-params", type=float, nargs=4, default=AVR_CAMERA_PARAMS, metavar=("FX", "FY", "CX", "CY"))
+    parser.add_argument("--tag-size", type=float, default=0.174, help="Tag edge length in meters")
+    parser.add_argument("--quad-decimate", type=float, nargs="+", default=[1.0, 1.5, 2.0])
+    parser.add_argument("--nthreads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--refine-edges", type=int, nargs="+", default=[1])
+    parser.add_argument("--output", type=str, help="Write results to this JSON file instead of stdout")
+
+    args = parser.parse_args()
+
+    frames = load_frames(args.source, args.width, args.height)
+    if not frames:
+        parser.error(f"No frames found in {args.source}")
+    logger.info(f"Loaded {len(frames)} frames from {args.source}")
+
+    truth = None
+    if args.truth:
+        with open(args.truth) as fp:
+            truth = json.load(fp)
+
+    report = {
+        "source": args.source,
+        "frames": len(frames),
+        "camera_params": list(args.camera_params),
+        "tag_size": args.tag_size,
+        "results": sweep(frames, tuple(args.camera_params), args.tag_size, args.quad_decimate, args.nthreads, args.refine_edges, truth),
+    }
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
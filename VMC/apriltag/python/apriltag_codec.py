@@ -0,0 +1,98 @@
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+# topic for binary encoded detections, the JSON ones stay on avr/apriltags/raw
+BINARY_TOPIC = "avr/apriltags/raw/binary"
+
+MAGIC = b"ATAG"
+VERSION = 2
+
+# fixed size header at the start of every message, little endian and packed,
+# matching the structs in avrapriltags.cpp. The capture, detection, and publish
+# times are from the monotonic clock, for latency tracing.
+HEADER_DTYPE = np.dtype(
+    [
+        ("magic", "S4"),
+        ("version", "<u2"),
+        ("count", "<u2"),
+        ("seq", "<u4"),
+        ("reserved", "<u4"),
+        ("timestamp", "<f8"),
+        ("detected", "<f8"),
+        ("published", "<f8"),
+    ]
+)
+
+# one record per tag directly after the header. The position of the tag in the
+# camera frame is in meters, and the rotation matrix is row-major.
+TAG_DTYPE = np.dtype(
+    [
+        ("id", "<i4"),
+        ("pos", "<f4", (3,)),
+        ("rotation", "<f4", (3, 3)),
+    ]
+)
+
+
+def encode(
+    ids: Iterable[int],
+    pos: Iterable[np.ndarray],
+    rotation: Iterable[np.ndarray],
+    seq: int = 0,
+    timestamp: float = 0.0,
+    detected: float = 0.0,
+    published: Optional[float] = None,
+) -> bytes:
+    """
+    Packs the detections from a single frame into a binary message. The publish
+    time defaults to now.
+    """
+    ids = list(ids)
+    tags = np.empty(len(ids), dtype=TAG_DTYPE)
+    tags["id"] = ids
+    tags["pos"] = np.reshape(list(pos), (-1, 3))
+    tags["rotation"] = np.reshape(list(rotation), (-1, 3, 3))
+
+    if published is None:
+        published = time.monotonic()
+
+    header = np.array([(MAGIC, VERSION, len(ids), seq & 0xFFFFFFFF, 0, timestamp, detected, published)], dtype=HEADER_DTYPE)
+    return header.tobytes() + tags.tobytes()
+
+
+def decode(payload: bytes) -> Tuple[np.void, np.ndarray]:
+    """
+    Unpacks a binary message into its header and a structured array of tags.
+    The tags are a read-only view of the payload, not a copy.
+    """
+    if len(payload) < HEADER_DTYPE.itemsize:
+        raise ValueError(f"AprilTag message too short ({len(payload)} bytes)")
+
+    header = np.frombuffer(payload, dtype=HEADER_DTYPE, count=1)[0]
+    if header["magic"] != MAGIC:
+        raise ValueError("Not a binary AprilTag message")
+    if header["version"] != VERSION:
+        raise ValueError(f"Unsupported AprilTag message version {header['version']}")
+
+    count = int(header["count"])
+    expected = HEADER_DTYPE.itemsize + TAG_DTYPE.itemsize * count
+    if len(payload) != expected:
+        raise ValueError(f"AprilTag message with {count} tags should be {expected} bytes, got {len(payload)}")
+
+    tags = np.frombuffer(payload, dtype=TAG_DTYPE, count=count, offset=HEADER_DTYPE.itemsize)
+    return header, tags
+
+
+def header_trace(header: np.void) -> Dict[str, float]:
+    """
+    Returns the latency trace carried by a message header, in the same format as
+    the `trace` of JSON payloads.
+    """
+    return {
+        "seq": int(header["seq"]),
+        "capture": float(header["timestamp"]),
+        "detected": float(header["detected"]),
+        "published": float(header["published"]),
+    }
@@ -1,22 +1,119 @@
 import math
+import os
 import subprocess
+import sys
+import time
 import warnings
-from typing import List, Optional, Tuple
+from typing import Any, Iterable, List, Optional, Tuple
 
+import apriltag_codec
 import numpy as np
+import paho.mqtt.client as mqtt
 import transforms3d as t3d
 from bell.avr.mqtt.client import MQTTModule
 from bell.avr.mqtt.payloads import (
     AvrApriltagsRawPayload,
-    AvrApriltagsRawTags,
     AvrApriltagsSelectedPayload,
     AvrApriltagsVisiblePayload,
     AvrApriltagsVisibleTags,
     AvrApriltagsVisibleTagsPosWorld,
 )
+from bell.avr.utils.decorators import try_except
 
 warnings.simplefilter("ignore", np.RankWarning)
 
+# tag36h11 has 587 codes
+NUM_TAG_IDS = 587
+
+
+class TagFilterBank:
+    """
+    Bank of constant velocity Kalman filters, one per tag ID, that smooths the
+    relative position, world position, and heading computed from each detection.
+
+    Every filtered value is an independent channel with a [value, rate] state.
+    State, covariance, and last update time live in arrays indexed by tag ID so
+    an update is a handful of vectorized operations. Heading is filtered in
+    degrees with the innovation wrapped to [-180, 180). A tag that has not been
+    seen for `timeout` seconds starts a new track.
+    """
+
+    # pos_rel x/y/z, pos_world x/y/z, heading
+    NUM_CHANNELS = 7
+    HEADING = 6
+
+    def __init__(
+        self,
+        timeout: float = 1.0,
+        pos_process_noise: float = 400.0,
+        heading_process_noise: float = 400.0,
+        pos_measurement_noise: float = 4.0,
+        heading_measurement_noise: float = 4.0,
+        num_ids: int = NUM_TAG_IDS,
+    ):
+        self.timeout = timeout
+
+        # white acceleration spectral density and measurement variance of each
+        # channel, in cm and degrees
+        self.q = np.array([pos_process_noise] * 6 + [heading_process_noise])
+        self.r = np.array([pos_measurement_noise] * 6 + [heading_measurement_noise])
+
+        self.x = np.zeros((num_ids, self.NUM_CHANNELS, 2))
+        self.P = np.zeros((num_ids, self.NUM_CHANNELS, 2, 2))
+        self.initialized = np.zeros((num_ids, self.NUM_CHANNELS), dtype=bool)
+        self.last_update = np.full(num_ids, -np.inf)
+
+    def expire(self, now: float) -> None:
+        """
+        Drops the tracks of tags that have not been seen within the timeout.
+        """
+        self.initialized[now - self.last_update > self.timeout] = False
+
+    def update(self, tag_id: int, z: np.ndarray, now: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Filters a measurement of the 7 channels for a tag. Channels that were not
+        measured should be NaN. Returns the filtered values and their variances.
+        """
+        measured = ~np.isnan(z)
+        x, P = self.x[tag_id], self.P[tag_id]
+
+        if now - self.last_update[tag_id] > self.timeout:
+            self.initialized[tag_id] = False
+
+        # start new tracks at the measurement, with an unknown rate
+        new = measured & ~self.initialized[tag_id]
+        x[new] = np.stack([z[new], np.zeros(new.sum())], axis=-1)
+        P[new] = np.diag([1.0, 1e4]) * self.r[new, None, None]
+        self.initialized[tag_id] |= new
+
+        # predict the existing tracks forward
+        dt = max(now - self.last_update[tag_id], 0.0)
+        F = np.array([[1.0, dt], [0.0, 1.0]])
+        Q = np.array([[dt**3 / 3, dt**2 / 2], [dt**2 / 2, dt]])
+        existing = self.initialized[tag_id] & ~new
+
+        x[existing] = x[existing] @ F.T
+        P[existing] = F @ P[existing] @ F.T + self.q[existing, None, None] * Q
+
+        # correct the existing tracks with the measurement
+        correct = existing & measured
+        y = z[correct] - x[correct, 0]
+        if correct[self.HEADING]:
+            y[-1] = (y[-1] + 180) % 360 - 180
+
+        Pc = P[correct]
+        S = Pc[:, 0, 0] + self.r[correct]
+        K = Pc[:, :, 0] / S[:, None]
+        x[correct] += K * y[:, None]
+        P[correct] = Pc - K[:, :, None] * Pc[:, None, 0, :]
+
+        x[self.HEADING, 0] %= 360
+        self.last_update[tag_id] = now
+
+        filtered = np.where(self.initialized[tag_id], x[:, 0], np.nan)
+        variance = np.where(self.initialized[tag_id], P[:, 0, 0], np.nan)
+        return filtered, variance
+
 
 class AprilTagModule(MQTTModule):
     def __init__(self):
@@ -32,6 +129,25 @@ class AprilTagModule(MQTTModule):
                 ],  # cam x = body -y; cam y = body x, cam z = body z
             },
             "tag_truth": {"0": {"rpy": [0, 0, 0], "xyz": [0, 0, 0]}},
+            # "cuda" runs the nvapriltags binary, "cpu" runs the pupil_apriltags
+            # pipeline for machines without a Jetson GPU
+            "detector": os.environ.get("APRILTAG_DETECTOR", "cuda"),
+            # frame source of the "cpu" detector: "v4l2" for a USB camera,
+            # "argus" for the Jetson CSI camera (needs OpenCV built with
+            # GStreamer), or "synthetic" for rendered frames
+            "capture": os.environ.get("APRILTAG_CAPTURE", "v4l2"),
+            # "json" keeps the avr/apriltags/raw schema, "binary" has the
+            # detector publish packed detections on avr/apriltags/raw/binary
+            "encoding": os.environ.get("APRILTAG_ENCODING", "json"),
+            # per-tag temporal filtering of the computed poses
+            "filter": {
+                "enabled": True,
+                "timeout": 1.0,  # seconds without a detection before a track is dropped
+                "pos_process_noise": 400.0,  # cm^2/s^3
+                "heading_process_noise": 400.0,  # deg^2/s^3
+                "pos_measurement_noise": 4.0,  # cm^2
+                "heading_measurement_noise": 4.0,  # deg^2
+            },
         }
 
         # dict to hold transformation matrixes
@@ -39,7 +155,16 @@ class AprilTagModule(MQTTModule):
         # setup transformation matrixes
         self.setup_transforms()
 
-        self.topic_map = {"avr/apriltags/raw": self.on_apriltag_message}
+        filter_config = {key: value for key, value in self.config["filter"].items() if key != "enabled"}
+        self.filters = TagFilterBank(**filter_config)
+
+        # monotonic time the message being handled arrived, for latency tracing
+        self.received = time.monotonic()
+
+        self.topic_map = {
+            "avr/apriltags/raw": self.on_apriltag_message,
+            apriltag_codec.BINARY_TOPIC: self.on_apriltag_binary_message,  # type: ignore
+        }
 
     def setup_transforms(self) -> None:
         cam_rpy = self.config["cam"]["rpy"]
@@ -68,13 +193,40 @@ class AprilTagModule(MQTTModule):
             H_to_from = f"H_{name}_cam"
             self.tm[H_to_from] = np.eye(4)
 
+    @try_except()
+    def on_message(self, client: mqtt.Client, userdata: Any, msg: mqtt.MQTTMessage) -> None:
+        self.received = time.monotonic()
+
+        # binary detections skip the JSON decoding done by the base class
+        if msg.topic == apriltag_codec.BINARY_TOPIC:
+            self.on_apriltag_binary_message(msg.payload)
+        else:
+            super().on_message(client, userdata, msg)
+
     def on_apriltag_message(self, payload: AvrApriltagsRawPayload) -> None:
+        tags = ((tag["id"], [tag["pos"]["x"], tag["pos"]["y"], tag["pos"]["z"]], tag["rotation"]) for tag in payload["tags"])
+        self.process_tags(tags, payload.get("trace", {}))  # type: ignore
+
+    def on_apriltag_binary_message(self, payload: bytes) -> None:
+        header, tags = apriltag_codec.decode(payload)
+        self.process_tags(zip(tags["id"].tolist(), tags["pos"], tags["rotation"]), apriltag_codec.header_trace(header))
+
+    def process_tags(self, tags: Iterable[Tuple[int, Any, Any]], trace: dict) -> None:
+        """
+        Computes and publishes the visible tags and the selected tag from the
+        (id, position, rotation) of every tag detected in a frame. The latency
+        trace from the detector is extended with the receive and processing
+        times and attached to both outputs.
+        """
         tag_list: List[AvrApriltagsVisibleTags] = []
 
         min_dist = 1000000
         closest_tag = None
 
-        for index, tag in enumerate(payload["tags"]):
+        now = time.monotonic()
+        self.filters.expire(now)
+
+        for index, (tag_id, tag_pos, tag_rotation) in enumerate(tags):
             (
                 id_,
                 horizontal_distance,
@@ -83,7 +235,7 @@ class AprilTagModule(MQTTModule):
                 pos_world,
                 pos_rel,
                 heading,
-            ) = self.handle_tag(tag)
+            ) = self.handle_tag(tag_id, tag_pos, tag_rotation)
 
             # weird special case (this shouldn't really happen though?)
             if id_ is None:
@@ -107,12 +259,26 @@ class AprilTagModule(MQTTModule):
                 },
             )
 
+            has_world = pos_world is not None and pos_world.any()
+
+            if self.config["filter"]["enabled"] and 0 <= id_ < NUM_TAG_IDS:
+                z = np.concatenate([pos_rel, pos_world if has_world else [np.nan] * 3, [heading]])  # type: ignore
+                filtered, variance = self.filters.update(id_, z, now)
+
+                # published alongside the raw values, None where a channel has no track
+                filtered = [None if np.isnan(v) else float(v) for v in filtered]
+                variance = [None if np.isnan(v) else float(v) for v in variance]
+                tag["pos_rel_filtered"] = {"x": filtered[0], "y": filtered[1], "z": filtered[2]}  # type: ignore
+                tag["pos_world_filtered"] = {"x": filtered[3], "y": filtered[4], "z": filtered[5]}  # type: ignore
+                tag["heading_filtered"] = filtered[6]  # type: ignore
+                tag["variance"] = {"pos_rel": variance[0:3], "pos_world": variance[3:6], "heading": variance[6]}  # type: ignore
+
             # add some more info if we had the truth data for the tag
-            if pos_world is not None and pos_world.any():
+            if has_world:
                 tag["pos_world"] = AvrApriltagsVisibleTagsPosWorld(
-                    x=pos_world[0],
-                    y=pos_world[1],
-                    z=pos_world[2],
+                    x=pos_world[0],  # type: ignore
+                    y=pos_world[1],  # type: ignore
+                    z=pos_world[2],  # type: ignore
                 )
                 if horizontal_distance < min_dist:
                     min_dist = horizontal_distance
@@ -120,10 +286,20 @@ class AprilTagModule(MQTTModule):
 
             tag_list.append(tag)
 
-        self.send_message("avr/apriltags/visible", AvrApriltagsVisiblePayload(tags=tag_list))
+        trace = dict(trace, received=self.received, processed=time.monotonic())
+
+        visible = AvrApriltagsVisiblePayload(tags=tag_list)
+        visible["trace"] = trace  # type: ignore
+        self.send_message("avr/apriltags/visible", visible)
 
         if closest_tag is not None:
             pos_world = tag_list[closest_tag]["pos_world"]
+            heading = tag_list[closest_tag]["heading"]
+
+            # prefer the smoothed pose so fusion does not resync on jitter
+            if "pos_world_filtered" in tag_list[closest_tag]:
+                pos_world = tag_list[closest_tag]["pos_world_filtered"]  # type: ignore
+                heading = tag_list[closest_tag]["heading_filtered"]  # type: ignore
 
             # this shouldn't happen
             assert pos_world["x"] is not None
@@ -137,9 +313,10 @@ class AprilTagModule(MQTTModule):
                     "e": pos_world["y"],
                     "d": pos_world["z"],
                 },
-                heading=tag_list[closest_tag]["heading"],
+                heading=heading,
             )
 
+            apriltag_position["trace"] = trace  # type: ignore
             self.send_message("avr/apriltags/selected", apriltag_position)
 
     def angle_to_tag(self, pos: Tuple[float, float, float]) -> float:
@@ -188,7 +365,7 @@ class AprilTagModule(MQTTModule):
 
         return H_rot.dot(H_tran)
 
-    def handle_tag(self, tag: AvrApriltagsRawTags) -> Tuple[
+    def handle_tag(self, tag_id: int, tag_pos: Any, tag_rotation: Any) -> Tuple[
         int,
         float,
         float,
@@ -199,16 +376,15 @@ class AprilTagModule(MQTTModule):
     ]:
         """
         Calculates the distance, position, and heading of the drone in NED frame
-        based on the tag detections.
+        based on the tag detections. The tag position is in the camera frame in
+        meters, and the rotation is a 3x3 matrix.
         """
 
-        tag_id = tag["id"]
-
-        tag_rot = np.asarray(tag["rotation"])
+        tag_rot = np.asarray(tag_rotation, dtype=float)
         rpy = t3d.euler.mat2euler(tag_rot)
         R = t3d.euler.euler2mat(0, 0, rpy[2], axes="rxyz")
         H_tag_cam = t3d.affines.compose(
-            [tag["pos"]["x"] * 100, tag["pos"]["y"] * 100, tag["pos"]["z"] * 100],
+            np.asarray(tag_pos, dtype=float) * 100,
             R,
             [1, 1, 1],
         )
@@ -238,7 +414,7 @@ class AprilTagModule(MQTTModule):
         angle = self.angle_to_tag(pos_rel)  # type: ignore
 
         # if we have a location definition for the visible tag
-        if str(tag["id"]) in self.config["tag_truth"].keys():
+        if str(tag_id) in self.config["tag_truth"].keys():
             H_cam_aeroRef = self.tm[f"H_{name}_aeroRef"].dot(H_cam_tag)
             H_aeroBody_aeroRef = H_cam_aeroRef.dot(self.tm["H_aeroBody_cam"])
 
@@ -265,7 +441,11 @@ class AprilTagModule(MQTTModule):
             )
 
     def run(self) -> None:
-        subprocess.Popen("/app/c/build/avrapriltags")
+        env = dict(os.environ, APRILTAG_ENCODING=self.config["encoding"], APRILTAG_CAPTURE=self.config["capture"])
+        if self.config["detector"] == "cpu":
+            subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "cpu_apriltag_library.py")], env=env)
+        else:
+            subprocess.Popen("/app/c/build/avrapriltags", env=env)
         super().run()
 
 
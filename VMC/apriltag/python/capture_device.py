@@ -1,10 +1,20 @@
+import time
 from typing import Optional, Tuple
 
 import cv2
 from bell.avr.utils.decorators import run_forever
+from frame_recorder import FrameRecorder
 from loguru import logger
 
 
+def has_gstreamer() -> bool:
+    """
+    Returns whether OpenCV was built with GStreamer, which the Jetson capture
+    pipelines need. The pip wheels are not.
+    """
+    return any(line.strip().startswith("GStreamer:") and "YES" in line for line in cv2.getBuildInformation().splitlines())
+
+
 class CaptureDevice:
     def __init__(
         self,
@@ -20,7 +30,13 @@ class CaptureDevice:
         # "gst-launch-1.0 nvarguscamerasrc ! 'video/x-raw(memory:NVMM),width=1920,height=1080,framerate=30/1,format=NV12' ! nvv4l2h265enc bitrate=10000000 iframeinterval=40 ! video/x-h265, stream-format=byte-stream ! rndbuffersize min=1500 max=1500 ! tee name=t ! queue ! udpsink host=192.168.1.140 port=5000 t. ! queue ! udpsink host=192.168.1.112 port=5000"
         # "gst-launch-1.0 nvarguscamerasrc ! 'video/x-raw(memory:NVMM),width=1920,height=1080,framerate=30/1,format=NV12' ! videoconvert ! nvoverlaysink"
 
-        if self.protocol == "v4l2":
+        if self.protocol == "v4l2" and not has_gstreamer():
+            # without GStreamer, read the camera through OpenCV's own v4l2
+            # backend, which decodes on the CPU
+            logger.warning("OpenCV has no GStreamer support, capturing from v4l2 without hardware decoding")
+            connection_string = None
+
+        elif self.protocol == "v4l2":
             # if the framerate argument is supplied, we will modify the connection
             # string to provide a rate limiter to the incoming string at virtually
             # no performance penalty
@@ -34,6 +50,9 @@ class CaptureDevice:
             connection_string = f"v4l2src device={video_device} io-mode=2 ! image/jpeg,width=1280,height=720,framerate=60/1 ! jpegparse ! nvv4l2decoder mjpeg=1 ! nvvidconv ! {frame_string} ! videoconvert ! video/x-raw,width={res[0]},height={res[1]},format=BGRx ! appsink"
 
         elif self.protocol == "argus":
+            if not has_gstreamer():
+                raise RuntimeError("The argus capture source needs OpenCV built with GStreamer, use the v4l2 source instead")
+
             if framerate is None:
                 frame_string = "video/x-raw,format=BGR"
             else:
@@ -50,8 +69,18 @@ class CaptureDevice:
         # this is how we might have to capture from csi cameras..
         # self.cv = cv2.VideoCapture("nvarguscamerasrc ! 'video/x-raw(memory:NVMM), width=1920, height=1080, framerate=30/1, format=NV12' ! videoconvert ! appsink sync=false",)
 
-        # create the gstreamer pipeline
-        self.cv = cv2.VideoCapture(connection_string)
+        if connection_string is None:
+            self.cv = cv2.VideoCapture(video_device, cv2.CAP_V4L2)
+            self.cv.set(cv2.CAP_PROP_FRAME_WIDTH, res[0])
+            self.cv.set(cv2.CAP_PROP_FRAME_HEIGHT, res[1])
+            if framerate is not None:
+                self.cv.set(cv2.CAP_PROP_FPS, framerate)
+        else:
+            # create the gstreamer pipeline
+            self.cv = cv2.VideoCapture(connection_string)
+
+        # records grayscale frames when enabled
+        self.recorder: Optional[FrameRecorder] = None
 
     def read(self) -> Tuple[bool, Optional[cv2.Mat]]:
         return self.cv.read()  #  type:ignore
@@ -60,8 +89,31 @@ class CaptureDevice:
         ret, img = self.cv.read()
         if ret:
             img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            if self.recorder is not None:
+                self.recorder.record(img, time.monotonic(), self.cv.get(cv2.CAP_PROP_EXPOSURE))
         return ret, img  #  type:ignore
 
+    def start_recording(self, path: str, capacity: int) -> None:
+        """
+        Records up to `capacity` grayscale frames from `read_gray` to a
+        memory-mapped file at `path`, without blocking capture.
+        """
+        self.stop_recording()
+        self.recorder = FrameRecorder(path, self.res[0], self.res[1], capacity)
+        self.recorder.start()
+
+    def stop_recording(self) -> None:
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def release(self) -> None:
+        """
+        Closes the camera so another pipeline can open it.
+        """
+        self.stop_recording()
+        self.cv.release()
+
     @run_forever(frequency=100)
     def run(self) -> None:
         # try to read frame
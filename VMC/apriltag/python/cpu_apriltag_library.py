@@ -1,33 +1,107 @@
+import functools
+import heapq
+import itertools
+import math
 import multiprocessing
+import os
+import queue
 import time
-from typing import List, Optional, Tuple
+from collections import deque
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
+import apriltag_codec
 import numpy as np
+from bell.avr.mqtt.client import MQTTModule
+from bell.avr.mqtt.payloads import (
+    AvrApriltagsFpsPayload,
+    AvrApriltagsRawPayload,
+    AvrApriltagsRawTags,
+    AvrFusionPositionNedPayload,
+)
 from bell.avr.utils.decorators import try_except
+from bell.avr.utils.timing import rate_limit
 from capture_device import CaptureDevice
+from frame_recorder import RecordingCapture
 from loguru import logger
 from pupil_apriltags import Detection, Detector
+from rectify import AVR_CAMERA_PARAMS, Rectifier
+
+DEFAULT_DETECTOR_PARAMS: Dict[str, Any] = {
+    "families": "tag36h11",
+    "nthreads": 2,
+    "quad_decimate": 1.5,
+    "quad_sigma": 0.0,
+    "refine_edges": 1,
+    "decode_sharpening": 0.25,
+    "debug": 0,
+}
+
+
+def available_cores() -> List[int]:
+    """
+    Returns the CPU cores this process is allowed to run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
 
 
 class AprilTagWrapper:
-    def __init__(self, camera_params: Tuple[float, float, float, float], tag_size: float):
-        self.camera_params = camera_params
+    def __init__(
+        self,
+        camera_params: Tuple[float, float, float, float],
+        tag_size: float,
+        detector_params: Optional[Dict[str, Any]] = None,
+        rectifier: Optional[Rectifier] = None,
+    ):
+        # frames are undistorted before detection if a rectifier is given,
+        # and pose is then estimated with the rectified intrinsics
+        self.rectifier = rectifier
+        self.camera_params = rectifier.camera_params if rectifier is not None else camera_params
         self.tag_size = tag_size
 
-        self.detector = Detector(
-            families="tag36h11",
-            nthreads=2,
-            quad_decimate=1.5,
-            quad_sigma=0.0,
-            refine_edges=1,
-            decode_sharpening=0.25,
-            debug=0,
-        )
+        # anything not supplied falls back to the defaults
+        self.detector_params = {**DEFAULT_DETECTOR_PARAMS, **(detector_params or {})}
+        self.detector = Detector(**self.detector_params)
+
+        # detectors for each decimation level, see `build_detectors`
+        self.detectors = {self.detector_params["quad_decimate"]: self.detector}
+
+    def build_detectors(self, levels: Iterable[float]) -> None:
+        """
+        Builds a detector for each decimation level up front, so switching
+        levels with `set_decimation` never stalls a frame.
+        """
+        for quad_decimate in levels:
+            if quad_decimate not in self.detectors:
+                self.detectors[quad_decimate] = Detector(**{**self.detector_params, "quad_decimate": quad_decimate})
+
+    def set_decimation(self, quad_decimate: float) -> None:
+        """
+        Switches to the detector with the given decimation, building it first if
+        `build_detectors` was not given that level.
+        """
+        self.build_detectors([quad_decimate])
+        self.detector = self.detectors[quad_decimate]
 
     def process_image(self, frame: np.uint8) -> List[Detection]:
         """
         Takes an image as input and returns the detected apriltags in list format
         """
+        if self.rectifier is not None:
+            frame = self.rectifier.apply(frame)  # type: ignore
+
         return self.detector.detect(
             frame,  #  type: ignore
             estimate_tag_pose=True,
@@ -36,6 +110,531 @@ class AprilTagWrapper:
         )  #  type: ignore
 
 
+class TagTrack(NamedTuple):
+    """
+    Last known image region of a tag, in pixels, and how far its center moved
+    between the two most recent detections.
+    """
+
+    top_left: np.ndarray
+    bottom_right: np.ndarray
+    velocity: np.ndarray
+
+
+class TrackingAprilTagWrapper(AprilTagWrapper):
+    """
+    AprilTag wrapper that only searches the image regions where tags were seen
+    recently. The region of each tag is predicted from its last detections,
+    padded, and the detector is run on that crop with the principal point
+    shifted to match. A full frame scan is done every `full_scan_interval`
+    frames, when nothing is being tracked, or when a tracked tag is lost.
+    """
+
+    def __init__(
+        self,
+        camera_params: Tuple[float, float, float, float],
+        tag_size: float,
+        detector_params: Optional[Dict[str, Any]] = None,
+        full_scan_interval: int = 15,
+        padding: float = 0.5,
+        min_padding: int = 24,
+        rectifier: Optional[Rectifier] = None,
+    ):
+        super().__init__(camera_params, tag_size, detector_params, rectifier)
+
+        self.full_scan_interval = full_scan_interval
+        # padding around the predicted region, as a fraction of the tag size, and in pixels
+        self.padding = padding
+        self.min_padding = min_padding
+
+        self.tracks: Dict[int, TagTrack] = {}
+        self.frames_since_scan = 0
+
+    def update_tracks(self, tags: List[Detection]) -> None:
+        """
+        Replaces the tracked regions with the given detections.
+        """
+        tracks = {}
+        for tag in tags:
+            velocity = np.zeros(2)
+            if tag.tag_id in self.tracks:
+                previous = self.tracks[tag.tag_id]
+                velocity = tag.center - (previous.top_left + previous.bottom_right) / 2
+
+            tracks[tag.tag_id] = TagTrack(tag.corners.min(axis=0), tag.corners.max(axis=0), velocity)
+
+        self.tracks = tracks
+
+    def predict_rois(self, shape: Tuple[int, ...]) -> List[Tuple[int, int, int, int]]:
+        """
+        Returns the padded (x0, y0, x1, y1) search regions for the next frame,
+        with overlapping regions merged.
+        """
+        height, width = shape[:2]
+        rois = []
+
+        for track in self.tracks.values():
+            size = track.bottom_right - track.top_left
+            pad = np.maximum(size * self.padding, self.min_padding) + np.abs(track.velocity)
+            x0, y0 = np.floor(track.top_left + track.velocity - pad).astype(int)
+            x1, y1 = np.ceil(track.bottom_right + track.velocity + pad).astype(int)
+            rois.append([max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)])
+
+        merged: List[List[int]] = []
+        for roi in sorted(rois):
+            for other in merged:
+                if roi[0] <= other[2] and other[0] <= roi[2] and roi[1] <= other[3] and other[1] <= roi[3]:
+                    other[:] = [min(roi[0], other[0]), min(roi[1], other[1]), max(roi[2], other[2]), max(roi[3], other[3])]
+                    break
+            else:
+                merged.append(roi)
+
+        return [tuple(roi) for roi in merged if roi[2] > roi[0] and roi[3] > roi[1]]  # type: ignore
+
+    def process_roi(self, frame: np.ndarray, roi: Tuple[int, int, int, int]) -> List[Detection]:
+        """
+        Runs the detector on a crop of the frame and maps the detections back
+        into full frame pixel coordinates. With a rectifier, only the crop is
+        undistorted.
+        """
+        x0, y0, x1, y1 = roi
+        fx, fy, cx, cy = self.camera_params
+
+        if self.rectifier is not None:
+            crop = self.rectifier.apply(frame, roi)
+        else:
+            crop = np.ascontiguousarray(frame[y0:y1, x0:x1])
+
+        tags = self.detector.detect(
+            crop,
+            estimate_tag_pose=True,
+            camera_params=(fx, fy, cx - x0, cy - y0),
+            tag_size=self.tag_size,
+        )
+
+        for tag in tags:
+            tag.center = tag.center + (x0, y0)
+            tag.corners = tag.corners + (x0, y0)
+
+        return tags
+
+    def process_image(self, frame: np.uint8) -> List[Detection]:
+        """
+        Takes an image as input and returns the detected apriltags in list format,
+        searching only around tracked tags when possible
+        """
+        self.frames_since_scan += 1
+
+        if self.tracks and self.frames_since_scan < self.full_scan_interval:
+            found: Dict[int, Detection] = {}
+            for roi in self.predict_rois(frame.shape):  # type: ignore
+                for tag in self.process_roi(frame, roi):  # type: ignore
+                    found.setdefault(tag.tag_id, tag)
+
+            # every tracked tag was found again
+            if found.keys() >= self.tracks.keys():
+                tags = list(found.values())
+                self.update_tracks(tags)
+                return tags
+
+        tags = super().process_image(frame)
+        self.frames_since_scan = 0
+        self.update_tracks(tags)
+        return tags
+
+
+class DecimationController:
+    """
+    Picks the detector decimation from the apparent size of the tags.
+
+    The smallest tag edge in pixels over the last `window` frames is used, or if
+    no tags were seen, the size a tag would have at the current altitude. The
+    coarsest level that keeps that edge at least `min_edge_px` pixels long after
+    decimation is chosen, so tags stay detectable close to the pad while the
+    detector does less work. When nothing is known, the finest level is used.
+
+    To keep settings from flapping, a coarser level is only chosen once the tag
+    is `hysteresis` larger than needed, and the level is held for at least
+    `hold_frames` frames after a change.
+    """
+
+    def __init__(
+        self,
+        focal_length: float,
+        tag_size: float,
+        levels: Sequence[float] = (1.0, 1.5, 2.0, 3.0),
+        min_edge_px: float = 30,
+        hysteresis: float = 0.25,
+        hold_frames: int = 10,
+        window: int = 5,
+    ):
+        self.focal_length = focal_length
+        self.tag_size = tag_size
+        self.levels = sorted(levels)
+        self.min_edge_px = min_edge_px
+        self.hysteresis = hysteresis
+        self.hold_frames = hold_frames
+
+        self.level = self.levels[0]
+        self.frames_held = 0
+        self.recent_edges: Deque[float] = deque(maxlen=window)
+
+    @staticmethod
+    def tag_edge_px(tag: Detection) -> float:
+        """
+        Returns the shortest edge of a detected tag, in pixels
+        """
+        corners = np.asarray(tag.corners)
+        return float(np.min(np.linalg.norm(corners - np.roll(corners, 1, axis=0), axis=1)))
+
+    def update(self, tags: List[Detection], altitude: float = math.nan) -> float:
+        """
+        Records the detections from a frame along with the current altitude above
+        the tags in meters, and returns the decimation to use for the next frame.
+        """
+        if tags:
+            self.recent_edges.append(min(self.tag_edge_px(tag) for tag in tags))
+        elif self.recent_edges:
+            self.recent_edges.popleft()
+
+        if self.recent_edges:
+            edge = min(self.recent_edges)
+        elif altitude > 0:
+            edge = self.focal_length * self.tag_size / altitude
+        else:
+            edge = 0.0
+
+        self.frames_held += 1
+
+        # always drop to a finer level right away if the tag is getting too small
+        if edge / self.level < self.min_edge_px:
+            finer = [level for level in self.levels if edge / level >= self.min_edge_px]
+            target = max(finer) if finer else self.levels[0]
+        elif self.frames_held >= self.hold_frames:
+            coarser = [level for level in self.levels if edge / level >= self.min_edge_px * (1 + self.hysteresis)]
+            target = max(coarser + [self.level])
+        else:
+            target = self.level
+
+        if target != self.level:
+            self.level = target
+            self.frames_held = 0
+
+        return self.level
+
+
+def autotune_detector(
+    frames: Sequence[np.ndarray],
+    camera_params: Tuple[float, float, float, float],
+    tag_size: float,
+    recall_target: float = 0.95,
+    nthreads_options: Iterable[int] = (1, 2, 4),
+    quad_decimate_options: Iterable[float] = (1.0, 1.5, 2.0, 3.0),
+    detector_params: Optional[Dict[str, Any]] = None,
+    cores: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Benchmarks combinations of per-worker detector threads and decimation on a set
+    of sample frames, and returns the fastest worker pool configuration whose
+    detection recall meets `recall_target`.
+
+    Recall is measured against a full resolution detector using every core.
+    Pipeline throughput is estimated as the number of workers that fit on the
+    available cores multiplied by the single worker framerate.
+    """
+    cores = cores or len(available_cores())
+    base_params = {**DEFAULT_DETECTOR_PARAMS, **(detector_params or {})}
+
+    # the reference detections that recall is measured against
+    reference = AprilTagWrapper(camera_params, tag_size, {**base_params, "nthreads": cores, "quad_decimate": 1.0})
+    truth = [{tag.tag_id for tag in reference.process_image(frame)} for frame in frames]
+    num_truth = sum(len(ids) for ids in truth)
+
+    results = []
+    for nthreads, quad_decimate in itertools.product(nthreads_options, quad_decimate_options):
+        if nthreads > cores:
+            continue
+
+        params = {**base_params, "nthreads": nthreads, "quad_decimate": quad_decimate}
+        atag = AprilTagWrapper(camera_params, tag_size, params)
+
+        found = 0
+        start = time.perf_counter()
+        for frame, ids in zip(frames, truth):
+            found += len(ids & {tag.tag_id for tag in atag.process_image(frame)})
+        per_frame = (time.perf_counter() - start) / max(len(frames), 1)
+
+        num_workers = max(1, cores // nthreads)
+        results.append(
+            {
+                "num_workers": num_workers,
+                "detector_params": params,
+                "fps": num_workers / per_frame if per_frame > 0 else float("inf"),
+                "latency_ms": per_frame * 1000,
+                "recall": found / num_truth if num_truth else 1.0,
+            }
+        )
+
+    passing = [result for result in results if result["recall"] >= recall_target]
+    if passing:
+        best = max(passing, key=lambda result: (result["fps"], -result["latency_ms"]))
+    else:
+        logger.warning(f"No detector configuration reached {recall_target:.0%} recall, using the one with the best recall")
+        best = max(results, key=lambda result: (result["recall"], result["fps"]))
+
+    logger.info(
+        f"Autotune chose {best['num_workers']} workers x {best['detector_params']['nthreads']} threads at quad_decimate {best['detector_params']['quad_decimate']} ({best['fps']:.1f} fps, {best['recall']:.0%} recall)"
+    )
+    return best
+
+
+class Frame(NamedTuple):
+    """
+    A grayscale image along with its capture sequence number and the monotonic
+    time it was captured at.
+    """
+
+    seq: int
+    timestamp: float
+    image: np.ndarray
+
+
+class TagResult(NamedTuple):
+    """
+    The detections for a single frame, stamped with the sequence number and
+    capture time of that frame and the time detection finished.
+    """
+
+    seq: int
+    timestamp: float
+    detected: float
+    tags: List[Detection]
+
+
+class LatestFrameScheduler:
+    """
+    Single slot handoff between the capture process and the perception workers.
+
+    Only the newest frame is ever waiting to be processed. If a frame has not been
+    picked up by an idle worker by the time the next one is captured, it is
+    superseded and dropped. Workers block on `get` instead of polling.
+
+    The frame lives in a shared memory buffer of up to `width` x `height` 8-bit
+    pixels, guarded by a condition variable. `put` overwrites it in place and
+    bumps the sequence number, and `get` copies it out, so nothing is pickled and
+    a superseded frame costs nothing to drop.
+    """
+
+    def __init__(self, width: int, height: int):
+        self._capacity = width * height
+        self._data = multiprocessing.RawArray("B", self._capacity)
+
+        # shape, sequence number, and capture time of the frame in the slot, and
+        # the sequence number of the last frame a worker took
+        self._shape = multiprocessing.RawArray("L", 2)
+        self._seq = multiprocessing.RawValue("q", -1)
+        self._timestamp = multiprocessing.RawValue("d", 0.0)
+        self._taken = multiprocessing.RawValue("q", -1)
+
+        self._dropped = multiprocessing.RawValue("L", 0)
+        self._ready = multiprocessing.Condition()
+
+    @property
+    def dropped(self) -> int:
+        """
+        Number of frames that were superseded before a worker picked them up
+        """
+        return self._dropped.value  # type: ignore
+
+    def _buffer(self) -> np.ndarray:
+        return np.frombuffer(self._data, dtype=np.uint8)  # type: ignore
+
+    def put(self, frame: Frame) -> None:
+        """
+        Offers a new frame to the workers, replacing any frame still waiting.
+        """
+        image = np.ascontiguousarray(frame.image, dtype=np.uint8)
+        if image.ndim != 2 or image.size > self._capacity:
+            raise ValueError(f"Expected a grayscale frame of at most {self._capacity} pixels, got shape {image.shape}")
+
+        with self._ready:
+            if self._seq.value > self._taken.value:  # type: ignore
+                self._dropped.value += 1  # type: ignore
+
+            self._buffer()[: image.size] = image.ravel()
+            self._shape[:] = image.shape
+            self._seq.value = frame.seq  # type: ignore
+            self._timestamp.value = frame.timestamp  # type: ignore
+
+            self._ready.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Frame:
+        """
+        Blocks until a frame is available and returns it. Raises `queue.Empty`
+        if none arrived within `timeout` seconds.
+        """
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._seq.value > self._taken.value, timeout):  # type: ignore
+                raise queue.Empty
+
+            height, width = self._shape[:]
+            image = self._buffer()[: height * width].reshape(height, width).copy()
+            self._taken.value = self._seq.value  # type: ignore
+
+            return Frame(self._seq.value, self._timestamp.value, image)  # type: ignore
+
+
+class ResultReorderer:
+    """
+    Releases perception results in capture order.
+
+    Each worker publishes the sequence number of the last frame it took in
+    `in_flight` (-1 before the first). A worker counts as busy with that frame
+    until its result has been received here, since results pass through a queue
+    after the worker has moved on. A result is held until no worker is busy with
+    an older frame, or until it has been held for `max_delay` seconds. Results
+    older than one that was already released arrive too late and are dropped.
+    """
+
+    def __init__(self, in_flight: Any, max_delay: float = 0.1):
+        self.in_flight = in_flight
+        self.max_delay = max_delay
+
+        self.pending: List[Tuple[int, float, TagResult]] = []
+        self.last_seq = -1
+        self.late = 0
+
+    def push(self, result: TagResult) -> List[TagResult]:
+        """
+        Adds a result and returns any results that are now ready, in order.
+        """
+        if result.seq <= self.last_seq:
+            self.late += 1
+            return []
+
+        heapq.heappush(self.pending, (result.seq, time.monotonic(), result))
+        return self.pop_ready()
+
+    def pop_ready(self) -> List[TagResult]:
+        """
+        Returns the held results that can be released, in order.
+        """
+        # a frame whose result is held or was already released (or is late
+        # anyway) is no longer worth waiting for
+        held = {seq for seq, _, _ in self.pending}
+        busy = [seq for seq in self.in_flight[:] if seq > self.last_seq and seq not in held]
+        oldest_busy = min(busy) if busy else float("inf")
+        now = time.monotonic()
+
+        ready = []
+        while self.pending:
+            seq, received, result = self.pending[0]
+            if seq > oldest_busy and now - received < self.max_delay:
+                break
+
+            heapq.heappop(self.pending)
+            self.last_seq = seq
+            ready.append(result)
+
+        return ready
+
+
+def detection_to_raw_tag(tag: Detection) -> AvrApriltagsRawTags:
+    """
+    Converts a pupil_apriltags detection into the `avr/apriltags/raw` tag schema
+    published by the CUDA detector: the tag position in the camera frame in
+    meters, and the row-major 3x3 rotation matrix.
+    """
+    x, y, z = np.asarray(tag.pose_t, dtype=float).ravel()
+    return AvrApriltagsRawTags(
+        id=int(tag.tag_id),
+        pos={"x": x, "y": y, "z": z},
+        rotation=np.asarray(tag.pose_R, dtype=float).tolist(),
+    )
+
+
+class AprilTagPublisher(MQTTModule):
+    """
+    Output stage for the CPU AprilTag pipeline. Publishes detections and the
+    framerate on the same topics as the CUDA `avrapriltags` binary so the CPU
+    pipeline can stand in for it.
+
+    With the "json" encoding, tags are published on `avr/apriltags/raw` with the
+    `AvrApriltagsRawPayload` schema. The "compact" encoding instead publishes
+    each batch on `avr/apriltags/raw/compact` as flat arrays:
+    `{"seq", "timestamp", "ids": [n], "pos": [3n], "rotation": [9n]}`. The
+    "binary" encoding publishes packed records on `avr/apriltags/raw/binary`, in
+    the format described in `apriltag_codec`.
+
+    Every encoding carries a latency trace of the frame's sequence number and
+    its capture, detection, and publish times on the monotonic clock, in the
+    `trace` key of JSON payloads or in the binary header.
+    """
+
+    encodings = ("json", "compact", "binary")
+
+    def __init__(self, encoding: str = "json"):
+        super().__init__()
+
+        if encoding not in self.encodings:
+            raise ValueError(f"Unknown encoding {encoding}, expected one of {self.encodings}")
+        self.encoding = encoding
+
+        # altitude from fusion in meters, shared with the perception workers
+        self.altitude = multiprocessing.Value("d", math.nan)
+
+        self.topic_map = {"avr/fusion/position/ned": self.on_position_message}
+
+    def on_position_message(self, payload: AvrFusionPositionNedPayload) -> None:
+        # fusion positions are in centimeters, relative to the ground
+        self.altitude.value = -payload["d"] / 100  # type: ignore
+
+    def publish_tags(self, tags: List[Detection], seq: int, timestamp: float, detected: float = 0.0) -> None:
+        """
+        Publishes the detections from a single frame. Like the CUDA detector,
+        nothing is published for frames without detections.
+        """
+        if not tags:
+            return
+
+        published = time.monotonic()
+        trace = {"seq": seq, "capture": timestamp, "detected": detected, "published": published}
+
+        if self.encoding == "binary":
+            payload = apriltag_codec.encode(
+                (int(tag.tag_id) for tag in tags),
+                (tag.pose_t for tag in tags),
+                (tag.pose_R for tag in tags),
+                seq,
+                timestamp,
+                detected,
+                published,
+            )
+            self._mqtt_client.publish(apriltag_codec.BINARY_TOPIC, payload)
+        elif self.encoding == "compact":
+            self.send_message(
+                "avr/apriltags/raw/compact",  # type: ignore
+                {
+                    "seq": seq,
+                    "timestamp": timestamp,
+                    "ids": [int(tag.tag_id) for tag in tags],
+                    "pos": np.concatenate([np.asarray(tag.pose_t, dtype=float).ravel() for tag in tags]).round(5).tolist(),
+                    "rotation": np.concatenate([np.asarray(tag.pose_R, dtype=float).ravel() for tag in tags]).round(5).tolist(),
+                    "trace": trace,
+                },
+            )
+        else:
+            payload = AvrApriltagsRawPayload(tags=[detection_to_raw_tag(tag) for tag in tags])
+            payload["trace"] = trace  # type: ignore
+            self.send_message("avr/apriltags/raw", payload)
+
+    def publish_fps(self, fps: float) -> None:
+        """
+        Publishes the pipeline framerate.
+        """
+        self.send_message("avr/apriltags/fps", AvrApriltagsFpsPayload(fps=int(fps)))
+
+
 class AprilTagVPS:
     def __init__(
         self,
@@ -45,27 +644,168 @@ class AprilTagVPS:
         camera_params: Tuple[float, float, float, float],
         tag_size: float,
         framerate: Optional[int] = None,
+        num_workers: Optional[int] = None,
+        detector_params: Optional[Dict[str, Any]] = None,
+        cpu_affinity: Optional[List[List[int]]] = None,
+        pin_workers: bool = True,
+        autotune: bool = False,
+        autotune_recall: float = 0.95,
+        autotune_frames: int = 30,
+        tracking: bool = False,
+        full_scan_interval: int = 15,
+        reorder_delay: float = 0.1,
+        publisher: Optional[AprilTagPublisher] = None,
+        capture_factory: Optional[Callable[[], Any]] = None,
+        record_path: Optional[str] = None,
+        record_capacity: int = 9000,
+        rectifier: Optional[Rectifier] = None,
+        adaptive_decimation: bool = False,
+        decimation_levels: Sequence[float] = (1.0, 1.5, 2.0, 3.0),
     ):
         # camera parameters
         self.protocol = protocol
         self.video_device = video_device
         self.res = res
         self.framerate = framerate
+        # builds the frame source, anything with a CaptureDevice style `read_gray`
+        self.capture_factory = capture_factory
+        # record the frames seen by the capture loop to this file
+        self.record_path = record_path
+        self.record_capacity = record_capacity
+
+        # pupil april tags parameters, each worker builds its own detector from these
+        self.camera_params = camera_params
+        self.tag_size = tag_size
+        self.detector_params = {**DEFAULT_DETECTOR_PARAMS, **(detector_params or {})}
+
+        # undistorts frames in the capture loop, or only the tracked regions in
+        # the workers when tracking is enabled. Pose is then solved with the
+        # camera matrix of the rectified image
+        self.rectifier = rectifier
+        if rectifier is not None:
+            if tuple(rectifier.source_camera_params) != tuple(camera_params):
+                logger.warning(f"Rectifier was calibrated for {rectifier.source_camera_params}, not {camera_params}, using the rectified camera matrix")
+            self.camera_params = rectifier.camera_params
+
+        # pick the decimation per frame from the apparent tag size and altitude
+        self.adaptive_decimation = adaptive_decimation
+        self.decimation_levels = decimation_levels
+
+        # worker pool, by default enough workers to fill every core
+        self.num_workers = num_workers
+        self.cpu_affinity = cpu_affinity
+        self.pin_workers = pin_workers
 
-        # pupil april tags wrapper
-        self.atag = AprilTagWrapper(camera_params=camera_params, tag_size=tag_size)
+        # benchmark detector settings on live frames before starting
+        self.autotune = autotune
+        self.autotune_recall = autotune_recall
+        self.autotune_frames = autotune_frames
 
-        # setup processing queue
-        self.img_queue = multiprocessing.Queue()
+        # only search around previously detected tags between full frame scans
+        self.tracking = tracking
+        self.full_scan_interval = full_scan_interval
+
+        # setup processing queues
+        self.scheduler = LatestFrameScheduler(*res)
         self.tags_queue = multiprocessing.Queue()
+        # longest time a result is held back waiting for an older frame
+        self.reorder_delay = reorder_delay
+        self.reorder: Optional[ResultReorderer] = None
+
+        # MQTT output stage, results are only kept locally without one
+        self.publisher = publisher
 
         self.tags = None
-        self.tags_timestamp = time.time()
+        # capture sequence number and monotonic capture time of the latest result
+        self.tags_seq = -1
+        self.tags_timestamp = time.monotonic()
 
         # record average framerate
         self.avg = 0.0
         # record number of images processed
         self.num_images = 0
+        # record capture to detection latency of recent frames, in seconds
+        self.latencies: Deque[float] = deque(maxlen=300)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the pipeline framerate, the number of frames dropped by the scheduler,
+        and percentiles of the capture to detection latency in milliseconds.
+        """
+        stats = {
+            "fps": self.avg,
+            "processed": self.num_images,
+            "dropped": self.scheduler.dropped,
+            "late": self.reorder.late if self.reorder else 0,
+        }
+
+        if self.latencies:
+            p50, p90, p99 = np.percentile(np.asarray(self.latencies), [50, 90, 99]) * 1000
+            stats.update(latency_p50_ms=float(p50), latency_p90_ms=float(p90), latency_p99_ms=float(p99), latency_max_ms=max(self.latencies) * 1000)
+
+        return stats
+
+    def log_stats(self) -> None:
+        """
+        Logs the current pipeline statistics.
+        """
+        stats = self.stats()
+        logger.info(", ".join(f"{key}: {value:.1f}" if isinstance(value, float) else f"{key}: {value}" for key, value in stats.items()))
+
+    def worker_affinity(self) -> List[List[int]]:
+        """
+        Returns the cores each perception worker is pinned to. Unless explicitly
+        configured, the available cores are split into contiguous blocks of
+        `nthreads` cores, wrapping around if there are more workers than blocks.
+        """
+        if self.cpu_affinity is not None:
+            return self.cpu_affinity
+
+        cores = available_cores()
+        nthreads = min(self.detector_params["nthreads"], len(cores))
+        num_workers = self.num_workers or max(1, len(cores) // nthreads)
+
+        return [[cores[(i * nthreads + j) % len(cores)] for j in range(nthreads)] for i in range(num_workers)]
+
+    def open_capture(self) -> Any:
+        """
+        Opens the frame source.
+        """
+        if self.capture_factory is not None:
+            return self.capture_factory()
+        return CaptureDevice(self.protocol, self.video_device, self.res, self.framerate)
+
+    def capture_samples(self) -> List[np.ndarray]:
+        """
+        Grabs a handful of frames from the camera to benchmark the detector with.
+        """
+        capture = self.open_capture()
+        samples = []
+
+        while len(samples) < self.autotune_frames:
+            ret, img = capture.read_gray()
+            if ret is True:
+                samples.append(img)
+
+        capture.release()
+        return samples
+
+    def run_autotune(self) -> None:
+        """
+        Picks the worker count and detector parameters from a benchmark on live frames.
+        """
+        logger.info(f"Autotuning detector on {self.autotune_frames} frames")
+        best = autotune_detector(
+            self.capture_samples(),
+            self.camera_params,
+            self.tag_size,
+            recall_target=self.autotune_recall,
+            detector_params=self.detector_params,
+        )
+
+        self.num_workers = best["num_workers"]
+        self.detector_params = best["detector_params"]
+        self.cpu_affinity = None
 
     def run(self) -> None:
         # sourcery skip: use-named-expression
@@ -74,91 +814,166 @@ class AprilTagVPS:
         a v4l2 camera @ 'video_device' and uses 'camera_params' along with
         'tag_size' to calculate pose.
         """
-        # we will setup 2 processing consumers for the imagery.
-        for i in range(2):
-            proc = multiprocessing.Process(target=self.perception_loop, args=[], daemon=True)  # type: ignore
+        if self.autotune:
+            self.run_autotune()
+
+        # setup one processing consumer per block of cores
+        affinity = self.worker_affinity()
+        logger.info(f"Starting {len(affinity)} perception workers with {self.detector_params['nthreads']} detector threads each")
+
+        # the sequence number each worker is currently processing
+        in_flight = multiprocessing.Array("q", [-1] * len(affinity), lock=False)
+        self.reorder = ResultReorderer(in_flight, self.reorder_delay)
+
+        for index, cores in enumerate(affinity):
+            proc = multiprocessing.Process(target=self.perception_loop, args=(in_flight, index, cores if self.pin_workers else None), daemon=True)
             proc.start()
 
         # start the capturing process
         proc = multiprocessing.Process(target=self.capture_loop, args=(), daemon=True)
         proc.start()
 
-        last_loop = time.time()
+        # connected after forking so the MQTT client only lives in this process
+        if self.publisher is not None:
+            self.publisher.run_non_blocking()
+
+        last_loop = time.monotonic()
         delta_buckets = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
         i = 0
 
         while True:
-            # if the perception loop has completed analysis on a frame,
-            # show some stats or even render the frame
-            if self.tags_queue.empty():
-                time.sleep(0.01)
-                continue
-
-            self.num_images += 1
-            now = time.time()
-
-            # try to get a tag from the queue
-            tags = self.tags_queue.get()
-            if tags:
-                self.tags = tags
-                self.tags_timestamp = now
-            else:
-                self.tags = []
+            # block until the perception loop has completed analysis on a frame,
+            # waking up in time to release results held back by the reorder stage
+            try:
+                ready = self.reorder.push(self.tags_queue.get(timeout=self.reorder_delay))
+            except queue.Empty:
+                ready = self.reorder.pop_ready()
+
+            for result in ready:
+                self.num_images += 1
+                now = time.monotonic()
+                self.latencies.append(result.detected - result.timestamp)
+
+                self.tags_seq = result.seq
+                if result.tags:
+                    self.tags = result.tags
+                    self.tags_timestamp = result.timestamp
+                else:
+                    self.tags = []
 
-            # calculate the framerate
-            tdelta = now - last_loop
-            delta_buckets[i % 10] = tdelta  # type: ignore
-            self.avg = 1 / (sum(delta_buckets) / 10)
-            last_loop = now
-            i += 1
+                # calculate the framerate
+                tdelta = now - last_loop
+                delta_buckets[i % 10] = tdelta  # type: ignore
+                self.avg = 1 / (sum(delta_buckets) / 10)
+                last_loop = now
+                i += 1
+
+                if self.publisher is not None:
+                    self.publisher.publish_tags(result.tags, result.seq, result.timestamp, result.detected)
+                    self.publisher.publish_fps(self.avg)
+
+            rate_limit(self.log_stats, period=5)
 
     def capture_loop(self) -> None:
         """
-        Captures frames from the camera and places them into the image queue
-        to be consumed downstream by "perception loop". Checks to make sure queue
-        is not being overloaded and limits queue size to "max_depth".
+        Captures frames from the camera and hands them to the scheduler to be
+        consumed downstream by "perception loop". The camera read blocks until the
+        next frame arrives, so there is no need to sleep between reads.
         """
-        max_depth = 3
-        capture = CaptureDevice(self.protocol, self.video_device, self.res, self.framerate)
+        capture = self.open_capture()
+        if self.record_path is not None:
+            # sources without their own recorder (synthetic or injected ones)
+            # are wrapped in one
+            if hasattr(capture, "start_recording"):
+                capture.start_recording(self.record_path, self.record_capacity)
+            else:
+                capture = RecordingCapture(capture, self.record_path, self.record_capacity)
 
         logger.success("Capture loop started!")
 
+        seq = 0
         while True:
             ret, img = capture.read_gray()
+            now = time.monotonic()
 
-            # if theres room in the queue and we have a valid image
-            if (self.img_queue.qsize() < max_depth) and (ret is True):
-                # put the image in the queue
-                self.img_queue.put(img)
+            if ret is True:
+                if self.rectifier is not None and not self.tracking:
+                    img = self.rectifier.apply(img)  # type: ignore
 
-            time.sleep(0.01)
+                self.scheduler.put(Frame(seq, now, img))  # type: ignore
+                seq += 1
 
     @try_except(reraise=True)
-    def perception_loop(self) -> None:
+    def perception_loop(self, in_flight: Any, index: int, cores: Optional[List[int]] = None) -> None:
         """
-        Pulls images off the image queue, hands them to the apriltag detector,
-        and then places the results in the tags queue.
+        Waits for the newest frame from the scheduler, hands it to the apriltag
+        detector, and then places the results in the tags queue. The sequence
+        number of each frame taken is published in `in_flight[index]` for the
+        reorder stage. If `cores` is given, the worker and its detector threads
+        are pinned to them.
         """
-        logger.success("Perception loop started!")
+        if cores is not None and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+
+        # the detector is built in the worker so its thread pool is created
+        # after pinning, and never shared across a fork
+        # self.camera_params is the rectified camera matrix when rectifying.
+        # Frames are already rectified by the capture loop unless tracking
+        if self.tracking:
+            atag = TrackingAprilTagWrapper(self.camera_params, self.tag_size, self.detector_params, self.full_scan_interval, rectifier=self.rectifier)
+        else:
+            atag = AprilTagWrapper(self.camera_params, self.tag_size, self.detector_params)
+
+        decimation = None
+        if self.adaptive_decimation:
+            decimation = DecimationController(atag.camera_params[0], self.tag_size, self.decimation_levels)
+            atag.build_detectors(decimation.levels)
+            atag.set_decimation(decimation.level)
+
+        logger.success(f"Perception loop started! (cores: {cores})")
 
         while True:
-            if not self.img_queue.empty():
-                img = self.img_queue.get()
-                tags = self.atag.process_image(img)
-                self.tags_queue.put(tags)
-            else:
-                time.sleep(0.01)
+            frame = self.scheduler.get()
+            in_flight[index] = frame.seq
+
+            tags = atag.process_image(frame.image)
+
+            if decimation is not None:
+                altitude = self.publisher.altitude.value if self.publisher is not None else math.nan
+                atag.set_decimation(decimation.update(tags, altitude))  # type: ignore
+            # in_flight is left set, the reorder stage stops waiting on this
+            # frame once it receives the result
+            self.tags_queue.put(TagResult(frame.seq, frame.timestamp, time.monotonic(), tags))
 
 
 if __name__ == "__main__":
+    # "v4l2" for a USB camera, "argus" for the Jetson CSI camera (needs OpenCV
+    # built with GStreamer), or "synthetic" for rendered frames when there is
+    # no camera
+    protocol = os.environ.get("APRILTAG_CAPTURE", "v4l2")
+    if protocol not in ("argus", "v4l2", "synthetic"):
+        raise ValueError(f"Unknown APRILTAG_CAPTURE {protocol}, expected argus, v4l2, or synthetic")
+
+    res = (1280, 720)
+    camera_params = AVR_CAMERA_PARAMS
+    tag_size = 0.174  # full size tag
+    # old comment had 0.057
+
+    capture_factory = None
+    if protocol == "synthetic":
+        from synthetic_capture import SyntheticCaptureDevice
+
+        capture_factory = functools.partial(SyntheticCaptureDevice, res, camera_params, tag_size)
+
     at = AprilTagVPS(
-        protocol="argus",
-        video_device="/dev/video0",
-        res=(1280, 720),
-        camera_params=(584.3866, 583.3444, 661.2944, 320.7182),
-        tag_size=0.174,  # full size tag
-        # old comment had 0.057
+        protocol=protocol,
+        video_device=os.environ.get("APRILTAG_VIDEO_DEVICE", "/dev/video0"),
+        res=res,
+        camera_params=camera_params,
+        tag_size=tag_size,
         framerate=None,
+        publisher=AprilTagPublisher(encoding=os.environ.get("APRILTAG_ENCODING", "json")),
+        capture_factory=capture_factory,
     )
 
     at.run()
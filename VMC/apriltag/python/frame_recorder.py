@@ -0,0 +1,224 @@
+import queue
+import threading
+import time
+from typing import Any, Iterator, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+MAGIC = b"AVRFRAME"
+VERSION = 1
+
+# fixed size header at the start of every recording
+HEADER_DTYPE = np.dtype(
+    [
+        ("magic", "S8"),
+        ("version", "<u4"),
+        ("width", "<u4"),
+        ("height", "<u4"),
+        ("capacity", "<u4"),
+        ("count", "<u4"),
+        ("reserved", "<u4", (9,)),
+    ]
+)
+
+# one entry per frame slot, directly after the header
+INDEX_DTYPE = np.dtype(
+    [
+        ("timestamp", "<f8"),
+        ("exposure", "<f4"),
+        ("reserved", "<u4"),
+    ]
+)
+
+# frame data starts on a page boundary
+PAGE_SIZE = 4096
+
+
+def _layout(width: int, height: int, capacity: int) -> Tuple[int, int]:
+    """
+    Returns the offset of the frame data and the total size of a recording file
+    """
+    frames_offset = HEADER_DTYPE.itemsize + INDEX_DTYPE.itemsize * capacity
+    frames_offset = -(-frames_offset // PAGE_SIZE) * PAGE_SIZE
+    return frames_offset, frames_offset + width * height * capacity
+
+
+def is_recording(path: str) -> bool:
+    """
+    Returns whether a file is a recording made by `FrameRecorder`
+    """
+    with open(path, "rb") as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+class FrameRecorder:
+    """
+    Records 8-bit grayscale frames into a preallocated memory-mapped file made up
+    of a fixed size header, an index of (timestamp, exposure) per frame, and the
+    frames back to back.
+
+    Frames are written from a background thread so the capture loop is never
+    blocked. If the writer falls behind (for example when the disk cannot keep up
+    with flushing pages), `record` drops the frame instead of waiting, and once
+    the file is full further frames are dropped too.
+    """
+
+    def __init__(self, path: str, width: int, height: int, capacity: int, max_pending: int = 8):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.capacity = capacity
+
+        frames_offset, size = _layout(width, height, capacity)
+        self._mm = np.memmap(path, dtype=np.uint8, mode="w+", shape=(size,))
+
+        self.header = self._mm[: HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        self.header["magic"] = MAGIC
+        self.header["version"] = VERSION
+        self.header["width"] = width
+        self.header["height"] = height
+        self.header["capacity"] = capacity
+        self.header["count"] = 0
+
+        self.index = self._mm[HEADER_DTYPE.itemsize : HEADER_DTYPE.itemsize + INDEX_DTYPE.itemsize * capacity].view(INDEX_DTYPE)
+        self.frames = self._mm[frames_offset:].reshape(capacity, height, width)
+
+        self.count = 0
+        self.dropped = 0
+
+        self._pending: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """
+        Starts the background writer thread.
+        """
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+        logger.info(f"Recording up to {self.capacity} frames to {self.path}")
+
+    def record(self, img: np.ndarray, timestamp: float, exposure: float = 0.0) -> bool:
+        """
+        Queues a frame to be written. Returns False if the frame was dropped.
+        """
+        if img.shape != (self.height, self.width):
+            raise ValueError(f"Expected a {self.width}x{self.height} grayscale frame, got shape {img.shape}")
+
+        try:
+            self._pending.put_nowait((img, timestamp, exposure))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _writer(self) -> None:
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+
+            if self.count >= self.capacity:
+                self.dropped += 1
+                continue
+
+            img, timestamp, exposure = item
+            self.frames[self.count] = img
+            self.index[self.count] = (timestamp, exposure, 0)
+
+            # the count is only bumped once the frame is complete, so readers
+            # of a recording in progress never see a partial frame
+            self.count += 1
+            self.header["count"] = self.count
+
+            if self.count == self.capacity:
+                logger.warning(f"Recording {self.path} is full, dropping further frames")
+
+    def close(self) -> None:
+        """
+        Writes any queued frames, and flushes the recording to disk.
+        """
+        if self._thread is not None:
+            self._pending.put(None)
+            self._thread.join()
+            self._thread = None
+
+        self._mm.flush()
+        logger.info(f"Recorded {self.count} frames to {self.path} ({self.dropped} dropped)")
+
+
+class RecordingCapture:
+    """
+    Wraps any frame source with a `read_gray` method, such as
+    `SyntheticCaptureDevice`, and records the frames it returns with a
+    `FrameRecorder` sized from the first frame. Everything else is passed
+    through to the wrapped source.
+    """
+
+    def __init__(self, capture: Any, path: str, capacity: int):
+        self.capture = capture
+        self.path = path
+        self.capacity = capacity
+        self.recorder: Optional[FrameRecorder] = None
+
+    def read_gray(self) -> Tuple[bool, Optional[np.ndarray]]:
+        ret, img = self.capture.read_gray()
+        if ret:
+            if self.recorder is None:
+                height, width = img.shape[:2]
+                self.recorder = FrameRecorder(self.path, width, height, self.capacity)
+                self.recorder.start()
+            self.recorder.record(img, time.monotonic())
+        return ret, img
+
+    def release(self) -> None:
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        self.capture.release()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.capture, name)
+
+
+class FrameReader:
+    """
+    Reads a recording made by `FrameRecorder`. Frames are returned as zero-copy,
+    read-only NumPy views into the memory-mapped file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mm = np.memmap(path, dtype=np.uint8, mode="r")
+
+        header = self._mm[: HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        if header["magic"] != MAGIC:
+            raise ValueError(f"{path} is not a frame recording")
+        if header["version"] != VERSION:
+            raise ValueError(f"Unsupported recording version {header['version']}")
+
+        self.width = int(header["width"])
+        self.height = int(header["height"])
+        self.capacity = int(header["capacity"])
+        self.count = int(header["count"])
+
+        frames_offset, _ = _layout(self.width, self.height, self.capacity)
+        self.index = self._mm[HEADER_DTYPE.itemsize : HEADER_DTYPE.itemsize + INDEX_DTYPE.itemsize * self.count].view(INDEX_DTYPE)
+        self.frames = self._mm[frames_offset : frames_offset + self.width * self.height * self.count].reshape(self.count, self.height, self.width)
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self.index["timestamp"]
+
+    @property
+    def exposures(self) -> np.ndarray:
+        return self.index["exposure"]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.frames[i]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        return iter(self.frames)
@@ -0,0 +1,126 @@
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+from bell.avr.mqtt.client import MQTTModule
+from bell.avr.utils.decorators import run_forever, try_except
+from loguru import logger
+
+
+class LatencyTracer(MQTTModule):
+    """
+    Consumer for the latency traces attached along the AprilTag pipeline.
+
+    Every stage adds a monotonic timestamp to the `trace` of its output, in
+    pipeline order: capture, detected, and published from the detector, received
+    and processed from the AprilTag processor, then the downstream consumers
+    (fusion on `avr/vio/resync`, and anything echoing a trace to
+    `avr/apriltags/trace`, like the sandbox).
+
+    The time spent in each stage is the gap to the previous timestamp, and is
+    named after the stage that finished. Percentiles of every stage, and of the
+    end-to-end latency from capture to the last stage of each trace, are
+    published on `avr/apriltags/latency` in milliseconds, over a rolling window
+    of frames.
+    """
+
+    def __init__(self, window: int = 500, period: float = 1.0):
+        super().__init__()
+
+        self.window = window
+        self.period = period
+
+        self.stages: Dict[str, Deque[float]] = {}
+        self.total: Dict[str, Deque[float]] = {}
+
+        # the same frame is traced once per consumer, so remember which stages
+        # of recent frames were already counted
+        self.seen: "OrderedDict[Tuple[int, str], None]" = OrderedDict()
+
+        self.topic_map = {
+            "avr/apriltags/visible": self.on_trace_message,
+            "avr/vio/resync": self.on_trace_message,
+            "avr/apriltags/trace": self.on_trace_message,
+        }
+
+    @try_except()
+    def on_trace_message(self, payload: dict) -> None:
+        trace = payload.get("trace")
+        if not trace or "capture" not in trace:
+            return
+
+        self.add_trace(trace)
+
+    def add_trace(self, trace: Dict[str, float]) -> None:
+        """
+        Records the stage durations of a single trace.
+        """
+        # stages that were not timed (like detection in older detectors) are 0
+        timestamps = [(stage, value) for stage, value in trace.items() if stage != "seq" and value]
+
+        for (_, start), (stage, end) in zip(timestamps, timestamps[1:]):
+            if "seq" in trace:
+                key = (int(trace["seq"]), stage)
+                if key in self.seen:
+                    continue
+
+                self.seen[key] = None
+                if len(self.seen) > self.window * 10:
+                    self.seen.popitem(last=False)
+
+            self.stages.setdefault(stage, deque(maxlen=self.window)).append(end - start)
+
+        # end-to-end latency, keyed by the last stage of the trace
+        last_stage, end = timestamps[-1]
+        self.total.setdefault(last_stage, deque(maxlen=self.window)).append(end - trace["capture"])
+
+    @staticmethod
+    def percentiles(values: Deque[float]) -> Dict[str, Optional[float]]:
+        """
+        Returns the 50th, 90th, and 99th percentile, and maximum of a list of
+        durations, in milliseconds.
+        """
+        arr = np.asarray(values, dtype=float) * 1000
+        p50, p90, p99 = np.percentile(arr, [50, 90, 99])
+        return {
+            "count": len(arr),
+            "p50": round(float(p50), 3),
+            "p90": round(float(p90), 3),
+            "p99": round(float(p99), 3),
+            "max": round(float(arr.max()), 3),
+        }
+
+    def report(self) -> dict:
+        """
+        Returns the stage breakdown and end-to-end latency percentiles.
+        """
+        return {
+            "stages": {stage: self.percentiles(values) for stage, values in self.stages.items() if values},
+            "total": {stage: self.percentiles(values) for stage, values in self.total.items() if values},
+        }
+
+    def publish_report(self) -> None:
+        report = self.report()
+        if not report["total"]:
+            return
+
+        self.send_message("avr/apriltags/latency", report)  # type: ignore
+
+        stages = report["stages"]
+        slowest: List[str] = sorted(stages, key=lambda stage: stages[stage]["p50"], reverse=True)
+        breakdown = ", ".join(f"{stage} {stages[stage]['p50']:.1f} ms" for stage in slowest)
+        logger.debug(f"AprilTag latency p50 by stage: {breakdown}")
+
+    def run(self) -> None:
+        self.run_non_blocking()
+
+        @run_forever(period=self.period)
+        def report_loop() -> None:
+            self.publish_report()
+
+        report_loop()
+
+
+if __name__ == "__main__":
+    tracer = LatencyTracer()
+    tracer.run()
@@ -0,0 +1,62 @@
+from typing import Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+# calibration of the Jetson CSI camera at 1280x720, matching cam_properties.cpp
+# and undistort.cpp. Shared by the CPU detector, benchmark, and synthetic frames
+# so the rectified image and the pose solver assume the same camera
+AVR_CAMERA_PARAMS = (784.0756786399139, 784.9009527658286, 677.124825443364, 385.33983488708003)
+AVR_FISHEYE_DISTORTION = (-0.013826167055651659, -0.11999744016996756, 0.2825695466585381, -0.22616481734332383)
+
+
+class Rectifier:
+    """
+    Removes lens distortion from grayscale frames with `cv2.remap`.
+
+    The remap tables are computed once from the calibration, in OpenCV's fixed
+    point format (`CV_16SC2` coordinates plus an interpolation table), which is
+    roughly twice as fast to apply as floating point maps. `apply` can also
+    rectify just a region of the output image, for detectors that only look at
+    part of the frame.
+
+    By default the rectified image keeps the original camera matrix, like the
+    CUDA detector does, so the pinhole `camera_params` used for pose stay the same.
+    """
+
+    def __init__(
+        self,
+        res: Tuple[int, int],
+        camera_params: Tuple[float, float, float, float] = AVR_CAMERA_PARAMS,
+        distortion: Sequence[float] = AVR_FISHEYE_DISTORTION,
+        fisheye: bool = True,
+        new_camera_params: Optional[Tuple[float, float, float, float]] = None,
+    ):
+        self.res = res
+        # the calibrated intrinsics, and those of the rectified image
+        self.source_camera_params = camera_params
+        self.camera_params = new_camera_params or camera_params
+
+        K = self._matrix(camera_params)
+        new_K = self._matrix(self.camera_params)
+        D = np.asarray(distortion, dtype=np.float64)
+
+        if fisheye:
+            self.map1, self.map2 = cv2.fisheye.initUndistortRectifyMap(K, D, np.eye(3), new_K, res, cv2.CV_16SC2)
+        else:
+            self.map1, self.map2 = cv2.initUndistortRectifyMap(K, D, np.eye(3), new_K, res, cv2.CV_16SC2)
+
+    @staticmethod
+    def _matrix(camera_params: Tuple[float, float, float, float]) -> np.ndarray:
+        fx, fy, cx, cy = camera_params
+        return np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]], dtype=np.float64)
+
+    def apply(self, img: np.ndarray, roi: Optional[Tuple[int, int, int, int]] = None) -> np.ndarray:
+        """
+        Returns the rectified frame, or only the (x0, y0, x1, y1) region of it.
+        """
+        if roi is None:
+            return cv2.remap(img, self.map1, self.map2, cv2.INTER_LINEAR)
+
+        x0, y0, x1, y1 = roi
+        return cv2.remap(img, self.map1[y0:y1, x0:x1], self.map2[y0:y1, x0:x1], cv2.INTER_LINEAR)
@@ -0,0 +1,245 @@
+import argparse
+import functools
+import json
+import math
+import os
+import time
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+from bell.avr.utils.decorators import run_forever
+from loguru import logger
+from rectify import AVR_CAMERA_PARAMS
+
+
+class SyntheticTag(NamedTuple):
+    """
+    Ground truth for a rendered tag. `rotation` and `translation` are the pose of
+    the tag in the camera frame, in the same convention as the pupil_apriltags
+    `pose_R` and `pose_t` (meters).
+    """
+
+    id: int
+    rotation: np.ndarray
+    translation: np.ndarray
+
+
+def rot_z(angle: float) -> np.ndarray:
+    """
+    Rotation matrix about the z axis, in radians
+    """
+    c, s = math.cos(angle), math.sin(angle)
+    return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+
+
+def rot_x(angle: float) -> np.ndarray:
+    """
+    Rotation matrix about the x axis, in radians
+    """
+    c, s = math.cos(angle), math.sin(angle)
+    return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+
+def hover_trajectory(t: float) -> List[SyntheticTag]:
+    """
+    Default scene, a single tag 0 seen from a drone hovering and drifting
+    between 1.2 and 1.8 meters above it while slowly yawing.
+    """
+    translation = np.array([0.25 * math.sin(0.5 * t), 0.15 * math.cos(0.3 * t), 1.5 + 0.3 * math.sin(0.2 * t)])
+    rotation = rot_z(0.3 * t) @ rot_x(0.1 * math.sin(0.7 * t))
+    return [SyntheticTag(0, rotation, translation)]
+
+
+class SyntheticCaptureDevice:
+    """
+    Stand-in for `CaptureDevice` that renders tag36h11 tags at known 6-DoF poses
+    with the given camera intrinsics, so the detection and pose pipeline can be
+    tested without a camera. Frames are streamed at `framerate`, with optional
+    Gaussian blur (sigma in pixels), Gaussian noise (sigma in gray levels), and an
+    exposure gain. The poses of the tags in the last frame are kept in `truth`.
+    """
+
+    def __init__(
+        self,
+        res: Tuple[int, int],
+        camera_params: Tuple[float, float, float, float],
+        tag_size: float,
+        framerate: Optional[float] = 30,
+        scene: Callable[[float], List[SyntheticTag]] = hover_trajectory,
+        blur: float = 0.0,
+        noise: float = 0.0,
+        exposure: float = 1.0,
+        background: int = 160,
+        seed: Optional[int] = None,
+    ):
+        self.res = res
+        self.camera_params = camera_params
+        self.tag_size = tag_size
+        self.framerate = framerate
+        self.scene = scene
+
+        # image degradations
+        self.blur = blur
+        self.noise = noise
+        self.exposure = exposure
+        self.background = background
+        self.rng = np.random.default_rng(seed)
+
+        fx, fy, cx, cy = camera_params
+        self.K = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]])
+
+        # cache of rendered tag images, including the white border
+        self.tag_images = {}
+
+        self.start = time.monotonic()
+        self.next_frame = self.start
+        self.truth: List[SyntheticTag] = []
+
+    def tag_image(self, tag_id: int) -> np.ndarray:
+        """
+        Returns the 10x10 cell image of a tag, including the white border, with
+        8 pixels per cell.
+        """
+        if tag_id not in self.tag_images:
+            dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_APRILTAG_36h11)
+            # the aruco marker is the 8x8 cell black square that the tag size refers to
+            marker = cv2.aruco.generateImageMarker(dictionary, tag_id, 64)
+            self.tag_images[tag_id] = cv2.copyMakeBorder(marker, 8, 8, 8, 8, cv2.BORDER_CONSTANT, value=255)
+
+        return self.tag_images[tag_id]
+
+    def project(self, tag: SyntheticTag) -> Optional[np.ndarray]:
+        """
+        Returns the pixel coordinates of the outer corners of a tag (top left, top
+        right, bottom right, bottom left of the tag image), or None if any corner
+        is behind the camera.
+        """
+        # the tag image is upside down in the tag frame used by pupil_apriltags,
+        # and the white border extends one cell past the black square
+        half = self.tag_size / 2 * 10 / 8
+        corners = np.array([[half, half, 0], [-half, half, 0], [-half, -half, 0], [half, -half, 0]])
+
+        cam = corners @ np.asarray(tag.rotation).T + np.asarray(tag.translation).ravel()
+        if np.any(cam[:, 2] <= 0):
+            return None
+
+        pixels = cam @ self.K.T
+        return (pixels[:, :2] / pixels[:, 2:]).astype(np.float32)
+
+    def render(self, t: float) -> Tuple[np.ndarray, List[SyntheticTag]]:
+        """
+        Renders the grayscale scene at time `t` seconds, and returns the image along
+        with the tags in front of the camera.
+        """
+        width, height = self.res
+        img = np.full((height, width), self.background, dtype=np.float32)
+        tags = []
+
+        for tag in self.scene(t):
+            corners = self.project(tag)
+            if corners is None:
+                continue
+            tags.append(tag)
+
+            tag_img = self.tag_image(tag.id)
+            size = tag_img.shape[0]
+            src = np.array([[0, 0], [size, 0], [size, size], [0, size]], dtype=np.float32)
+            H = cv2.getPerspectiveTransform(src, corners)
+
+            warped = cv2.warpPerspective(tag_img.astype(np.float32), H, (width, height), flags=cv2.INTER_LINEAR)
+            mask = cv2.warpPerspective(np.ones_like(tag_img, dtype=np.float32), H, (width, height), flags=cv2.INTER_LINEAR)
+            img = img * (1 - mask) + warped
+
+        img *= self.exposure
+        if self.blur > 0:
+            img = cv2.GaussianBlur(img, (0, 0), self.blur)
+        if self.noise > 0:
+            img += self.rng.normal(0, self.noise, img.shape).astype(np.float32)
+
+        return np.clip(img, 0, 255).astype(np.uint8), tags
+
+    def read_gray(self) -> Tuple[bool, Optional[np.ndarray]]:
+        # pace frames to the target framerate, like a real camera would
+        if self.framerate:
+            delay = self.next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_frame = max(self.next_frame + 1 / self.framerate, time.monotonic())
+
+        img, self.truth = self.render(time.monotonic() - self.start)
+        return True, img
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        ret, img = self.read_gray()
+        return ret, cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)  # type: ignore
+
+    def release(self) -> None:
+        pass
+
+    @run_forever(frequency=100)
+    def run(self) -> None:
+        self.read()
+
+
+def write_dataset(device: SyntheticCaptureDevice, directory: str, num_frames: int, period: float = 0.1) -> None:
+    """
+    Renders `num_frames` frames, `period` seconds of scene time apart, into a
+    directory of images along with a `truth.json` in the format used by
+    `apriltag_benchmark.py`.
+    """
+    os.makedirs(directory, exist_ok=True)
+    truth = {}
+
+    for index in range(num_frames):
+        img, tags = device.render(index * period)
+        name = f"{index:05d}.png"
+        cv2.imwrite(os.path.join(directory, name), img)
+        truth[name] = [{"id": tag.id, "pos": np.asarray(tag.translation).ravel().tolist(), "rotation": np.asarray(tag.rotation).tolist()} for tag in tags]
+
+    with open(os.path.join(directory, "truth.json"), "w") as fp:
+        json.dump(truth, fp)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the CPU AprilTag pipeline on synthetic frames")
+    parser.add_argument("--fps", type=float, default=30, help="Target framerate")
+    parser.add_argument("--blur", type=float, default=0.0, help="Gaussian blur sigma in pixels")
+    parser.add_argument("--noise", type=float, default=0.0, help="Gaussian noise sigma in gray levels")
+    parser.add_argument("--exposure", type=float, default=1.0, help="Exposure gain")
+    parser.add_argument("--dataset", type=str, help="Write frames and ground truth to this directory instead of running the pipeline")
+    parser.add_argument("--frames", type=int, default=300, help="Number of frames to write with --dataset")
+
+    args = parser.parse_args()
+
+    res = (1280, 720)
+    camera_params = AVR_CAMERA_PARAMS
+    tag_size = 0.174
+
+    make_device = functools.partial(
+        SyntheticCaptureDevice,
+        res,
+        camera_params,
+        tag_size,
+        framerate=args.fps,
+        blur=args.blur,
+        noise=args.noise,
+        exposure=args.exposure,
+    )
+
+    if args.dataset:
+        write_dataset(make_device(), args.dataset, args.frames)
+        logger.success(f"Wrote {args.frames} frames to {args.dataset}")
+    else:
+        from cpu_apriltag_library import AprilTagPublisher, AprilTagVPS
+
+        at = AprilTagVPS(
+            protocol="synthetic",
+            video_device="",
+            res=res,
+            camera_params=camera_params,
+            tag_size=tag_size,
+            capture_factory=make_device,
+            publisher=AprilTagPublisher(),
+        )
+        at.run()
@@ -1,8 +1,13 @@
 import asyncio
+import collections
 import contextlib
+import contextvars
+import hashlib
+import itertools
+import json
 import math
-import queue
-from typing import Any, Callable, List
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
 
 import mavsdk
 import numpy as np
@@ -13,6 +18,7 @@ import pymap3d
 # from bell.avr.mqtt.client import MQTTModule
 # from bell.avr.mqtt.payloads import AvrFcmEventsPayload
 from bell.avr.utils.decorators import async_try_except  # , try_except
+from fcc_mission import optimize_waypoints
 from fcc_mqtt import FCMMQTTModule
 
 # from bell.avr.utils.timing import rate_limit
@@ -22,71 +28,355 @@ from mavsdk.geofence import Point, Polygon
 from mavsdk.mission_raw import MissionItem, MissionRawError
 from pymavlink import mavutil
 
+# Dispatcher lanes. Actions in the same lane run one at a time, in the order
+# they arrive, and actions in different lanes run concurrently. While a lane is
+# busy, up to `backlog` actions wait for it, and any more are rejected.
+#   priority: lower runs first, for display and logging
+#   preempt: cancel the running and waiting actions of every lower priority
+#            lane when an action arrives. Actions of the same lane still queue
+#   timeout: seconds an action in the lane may run before it is abandoned
+#   actions: the actions in the lane, any action not listed runs in "flight"
+DISPATCH_LANES: Dict[str, Dict[str, Any]] = {
+    "safety": {"priority": 0, "preempt": True, "timeout": 10, "backlog": 5, "actions": ["kill", "land", "disarm"]},
+    "flight": {
+        "priority": 1,
+        "preempt": False,
+        "timeout": 10,
+        "backlog": 5,
+        "actions": ["break", "connect", "arm", "reboot", "takeoff", "goto_location", "goto_location_ned", "start_mission"],
+    },
+    # mission uploads touch a different part of PX4 than the flight actions,
+    # so the next leg can be uploaded while the drone is flying. Starting a
+    # mission changes the flight mode, so it stays in the flight lane
+    "mission": {"priority": 2, "preempt": False, "timeout": 30, "backlog": 5, "actions": ["upload_mission", "set_geofence"]},
+}
+
+
+# WGS84 semi-major axis and first eccentricity squared
+WGS84_A = 6378137.0
+WGS84_E2 = 6.69437999014e-3
+
+# default distance (m) from a goto target, and time (s) spent within it, for
+# the goto to count as complete
+GOTO_ACCEPT_RADIUS = 0.5
+GOTO_DWELL_TIME = 0.0
+
+
+class GotoTarget:
+    """
+    Target of a goto, with the meters per degree of latitude and longitude at
+    the target cached so the distance to it is a few multiplications per
+    position update. Over the distances where the acceptance radius matters, the
+    local tangent plane is indistinguishable from a full geodetic conversion.
+    """
+
+    def __init__(self, lat: float, lon: float, alt: float, accept_radius: float = GOTO_ACCEPT_RADIUS, dwell_time: float = GOTO_DWELL_TIME) -> None:
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt
+        self.accept_radius = accept_radius
+        self.dwell_time = dwell_time
+
+        # meridian and prime vertical radii of curvature at the target
+        phi = math.radians(lat)
+        w = 1 - WGS84_E2 * math.sin(phi) ** 2
+        self.m_per_deg_lat = math.radians(WGS84_A * (1 - WGS84_E2) / w**1.5)
+        self.m_per_deg_lon = math.radians(WGS84_A / math.sqrt(w) * math.cos(phi))
+
+        # monotonic time the drone entered the acceptance radius
+        self.entered: Optional[float] = None
+
+    def distance(self, lat: float, lon: float, alt: float) -> float:
+        """
+        Distance in meters from the target.
+        """
+        n = (lat - self.lat) * self.m_per_deg_lat
+        e = (lon - self.lon) * self.m_per_deg_lon
+        d = alt - self.alt
+        return math.sqrt(n * n + e * e + d * d)
+
+    def reached(self, lat: float, lon: float, alt: float, now: float) -> bool:
+        """
+        Returns whether the drone has been within the acceptance radius for the
+        dwell time.
+        """
+        if self.distance(lat, lon, alt) > self.accept_radius:
+            self.entered = None
+            return False
+
+        if self.entered is None:
+            self.entered = now
+        return now - self.entered >= self.dwell_time
+
+
+# waypoint type: (MAV_CMD, params 1-4 of the mission item from the waypoint)
+MISSION_COMMANDS: Dict[str, Tuple[int, Callable[[dict], Tuple[float, float, float, float]]]] = {
+    # https://mavlink.io/en/messages/common.html#MAV_CMD_NAV_TAKEOFF
+    # This takeoff command probably works, but missions without takeoff commands will just takeoff anyways.
+    # See these PX4 docs for what I'm talking about: https://docs.px4.io/main/en/flight_modes_mc/mission.html#mission-takeoff
+    # pitch, empty, empty, yaw angle
+    "takeoff": (mavutil.mavlink.MAV_CMD_NAV_TAKEOFF, lambda waypoint: (5, float("nan"), float("nan"), waypoint["yaw"])),
+    # https://mavlink.io/en/messages/common.html#MAV_CMD_NAV_WAYPOINT
+    # hold time, acceptance radius, 0 to pass through the WP (if > 0 radius to pass by WP. Positive value for clockwise orbit,
+    # negative value for counter-clockwise orbit. Allows trajectory control), yaw angle (float("nan") to use the current
+    # system yaw heading mode, https://docs.px4.io/main/en/advanced_config/parameter_reference.html#MPC_YAW_MODE)
+    "goto": (mavutil.mavlink.MAV_CMD_NAV_WAYPOINT, lambda waypoint: (waypoint["holdTime"], waypoint["acceptRadius"], 0, waypoint["yaw"])),
+    # https://mavlink.io/en/messages/common.html#MAV_CMD_NAV_LAND
+    # abort altitude (0 uses system default), precision landing mode (https://mavlink.io/en/messages/common.html#PRECISION_LAND_MODE,
+    # disabled, we don't use beacons), empty, yaw angle
+    "land": (mavutil.mavlink.MAV_CMD_NAV_LAND, lambda waypoint: (0, mavutil.mavlink.PRECISION_LAND_MODE_DISABLED, float("nan"), waypoint["yaw"])),
+    # https://mavlink.io/en/messages/common.html#MAV_CMD_NAV_LOITER_UNLIM
+    # empty, empty, unused by multicopters, yaw angle
+    "loiter": (mavutil.mavlink.MAV_CMD_NAV_LOITER_UNLIM, lambda waypoint: (float("nan"), float("nan"), 0, waypoint["yaw"])),
+}
+
+
+def mission_hash(mission_items: List[MissionItem]) -> str:
+    """
+    Content hash of a list of MissionItems.
+    """
+    digest = hashlib.sha256()
+    for item in mission_items:
+        fields = (
+            item.seq,
+            item.frame,
+            item.command,
+            item.current,
+            item.autocontinue,
+            item.param1,
+            item.param2,
+            item.param3,
+            item.param4,
+            item.x,
+            item.y,
+            item.z,
+            item.mission_type,
+        )
+        digest.update(repr(fields).encode())
+    return digest.hexdigest()
+
+
+# trace of the action being run, set by the dispatcher for each action task.
+# A trace maps stage names to the monotonic time the action reached them:
+#   received: the action arrived on MQTT
+#   dequeued: the dispatcher took it off the action queue
+#   started: its lane was free and it started running
+#   command_sent: the first MAVLink command was sent through mavsdk
+#   acked: PX4 acknowledged the last MAVLink command
+#   done: the action finished
+ACTION_TRACE: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("ACTION_TRACE", default=None)
+TRACE_STAGES = ("received", "dequeued", "started", "command_sent", "acked", "done")
+
+# completed actions of each type that latency percentiles are computed over
+LATENCY_WINDOW = 100
+
+
+def mark_stage(stage: str, first: bool = False) -> None:
+    """
+    Records that the running action reached a stage. With `first`, a stage the
+    action already reached is not overwritten.
+    """
+    trace = ACTION_TRACE.get()
+    if trace is not None and not (first and stage in trace):
+        trace[stage] = time.monotonic()
+
+
+def trace_breakdown(trace: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Milliseconds spent reaching each stage of a trace from the previous stage
+    it reached, and the total from received to done.
+    """
+    stages = [stage for stage in TRACE_STAGES if stage in trace]
+    breakdown = {stage: round((trace[stage] - trace[previous]) * 1000, 3) for previous, stage in zip(stages[:-1], stages[1:])}
+    if "received" in trace and "done" in trace:
+        breakdown["total"] = round((trace["done"] - trace["received"]) * 1000, 3)
+    return breakdown
+
 
 class DispatcherBusy(Exception):
     """
     Exception for when the action dispatcher is currently busy
-    executing another action
+    executing another action and the backlog of its lane is full
     """
 
 
 class DispatcherManager(FCMMQTTModule):
     # region DispatcherManager
-    def __init__(self) -> None:
+    def __init__(self, lanes: Optional[Dict[str, Dict[str, Any]]] = None, on_preempt: Optional[Callable[[], None]] = None) -> None:
         super().__init__()
-        self.currently_running_task = None
-        self.timeout = 10
+        self.lanes = lanes or DISPATCH_LANES
+        self.lane_of = {action: lane for lane, config in self.lanes.items() for action in config["actions"]}
+
+        # called whenever a preempting action arrives, to drop any state left
+        # behind by the actions it overrides
+        self.on_preempt = on_preempt
+
+        # running task and waiting actions of each lane
+        self.running: Dict[str, Optional[Tuple[str, asyncio.Task]]] = {lane: None for lane in self.lanes}
+        self.backlog: Dict[str, Deque[Tuple[Callable, dict, str, Optional[Dict[str, Any]]]]] = {lane: collections.deque() for lane in self.lanes}
+
+        # queue wait and execution time of each action type, in milliseconds
+        self.action_stats: Dict[str, Dict[str, Any]] = {}
+        # breakdowns of the last completed actions of each type
+        self.latencies: Dict[str, Deque[Dict[str, float]]] = {}
 
-    async def schedule_task(self, task: Callable, payload: Any, name: str) -> None:
+    async def schedule_task(self, task: Callable, payload: Any, name: str, trace: Optional[Dict[str, Any]] = None) -> None:
         """
         Schedule a task (async func) to be run by the dispatcher with the
-        given payload. Task name is also required for printing.
+        given payload. Task name is also required for printing. `trace` is the
+        latency trace of the action, see ACTION_TRACE.
         """
-        logger.debug(f"Scheduling a task for '{name}'")
-        # if the dispatcher is ok to take on a new task
-        if (self.currently_running_task is not None and self.currently_running_task.done()) or self.currently_running_task is None:
-            await self.create_task(task, payload, name)
+        lane = self.lane_of.get(name, "flight")
+        logger.debug(f"Scheduling a task for '{name}' in the {lane} lane")
+
+        if self.lanes[lane]["preempt"]:
+            self.preempt(lane)
+
+        if self.running[lane] is None:
+            self.create_task(lane, task, payload, name, trace)
+        elif len(self.backlog[lane]) < self.lanes[lane]["backlog"]:
+            logger.info(f"Task '{name}' waiting for '{self.running[lane][0]}' to finish")  # type: ignore
+            self.backlog[lane].append((task, payload, name, trace))
         else:
             raise DispatcherBusy
 
-    async def create_task(self, task: Callable, payload: dict, name: str) -> None:
+    def preempt(self, lane: str) -> None:
+        """
+        Cancels the running and waiting actions of every lower priority lane.
+        The running action of the given lane is left alone, so a safety action
+        that is already running (such as a kill) finishes and reports its result.
+        """
+        priority = self.lanes[lane]["priority"]
+
+        for other, config in self.lanes.items():
+            if config["priority"] <= priority:
+                continue
+
+            while self.backlog[other]:
+                name = self.backlog[other].popleft()[2]
+                logger.warning(f"Task '{name}' dropped by the {lane} lane")
+                self._publish_event("action_preempted_event", name)
+
+            if self.running[other] is not None:
+                name, running_task = self.running[other]  # type: ignore
+                logger.warning(f"Task '{name}' preempted by the {lane} lane")
+                running_task.cancel()
+                # the lane is free now, the cancelled task finishes on its own
+                self.running[other] = None
+
+        if self.on_preempt is not None:
+            self.on_preempt()
+
+    def create_task(self, lane: str, task: Callable, payload: dict, name: str, trace: Optional[Dict[str, Any]] = None) -> None:
         """
-        Create a task to be run.
+        Create a task to be run in a lane. The next waiting task of the lane is
+        started once it is done.
         """
-        self.currently_running_task = asyncio.create_task(self.task_waiter(task, payload, name))
+        running_task = asyncio.create_task(self.task_waiter(task, payload, name, self.lanes[lane]["timeout"], trace))
+        self.running[lane] = (name, running_task)
+        running_task.add_done_callback(lambda t: self.task_done(lane, t))
+
+    def task_done(self, lane: str, running_task: asyncio.Task) -> None:
+        """
+        Frees the lane of a finished task and starts the next waiting task.
+        """
+        # a preempted task finishes after its lane has been reused
+        if self.running[lane] is None or self.running[lane][1] is not running_task:  # type: ignore
+            return
+
+        self.running[lane] = None
+        if self.backlog[lane]:
+            self.create_task(lane, *self.backlog[lane].popleft())
 
-    async def task_waiter(self, task: Callable, payload: dict, name: str) -> None:
+    async def task_waiter(self, task: Callable, payload: dict, name: str, timeout: float, trace: Optional[Dict[str, Any]] = None) -> None:
         """
         Execute a task with a timeout.
         """
+        trace = trace if trace is not None else {}
+        trace["started"] = time.monotonic()
+        # the task runs in a copy of this context, so it can mark its stages
+        ACTION_TRACE.set(trace)
+
         try:
-            await asyncio.wait_for(task(**payload), timeout=self.timeout)
-            self._publish_event(f"request_{name}_completed_event")
-            self.currently_running_task = None
+            await asyncio.wait_for(task(**payload), timeout=timeout)
+            trace["done"] = time.monotonic()
+            self.record_timing(name, trace)
+            self._publish_event(f"request_{name}_completed_event", json.dumps({"id": trace.get("id"), "latency_ms": trace_breakdown(trace)}))
 
         except asyncio.TimeoutError:
             try:
                 logger.warning(f"Task '{name}' timed out!")
+                trace["done"] = time.monotonic()
+                self.record_timing(name, trace, completed=False)
                 self._publish_event("action_timeout_event", name)
-                self.currently_running_task = None
 
             except Exception:
                 logger.exception("ERROR IN TIMEOUT HANDLER")
 
+        except asyncio.CancelledError:
+            self._publish_event("action_preempted_event", name)
+
         except Exception:
             logger.exception("ERROR IN TASK WAITER")
 
+    def record_timing(self, name: str, trace: Dict[str, Any], completed: bool = True) -> None:
+        """
+        Logs the queue wait and execution time of an action, and publishes the
+        running stats of every action type on avr/fcm/action_stats. The stage
+        latency percentiles of completed actions are published on
+        avr/fcm/action_latency.
+        """
+        queue_wait = trace["started"] - trace.get("received", trace["started"])
+        execution = trace["done"] - trace["started"]
+        logger.debug(f"Task '{name}' ({trace.get('id')}) waited {queue_wait * 1000:.1f} ms in the queue and ran for {execution * 1000:.1f} ms: {trace_breakdown(trace)}")
+
+        stats = self.action_stats.setdefault(name, {"count": 0})
+        stats["count"] += 1
+        for key, seconds in (("queue_wait_ms", queue_wait), ("execution_ms", execution)):
+            ms = round(seconds * 1000, 3)
+            if key not in stats:
+                stats[key] = {"last": ms, "mean": ms, "max": ms}
+                continue
+            stats[key]["last"] = ms
+            stats[key]["mean"] = round(stats[key]["mean"] + (ms - stats[key]["mean"]) / stats["count"], 3)
+            stats[key]["max"] = max(stats[key]["max"], ms)
+
+        self.send_message("avr/fcm/action_stats", self.action_stats)  # type: ignore
+
+        if not completed:
+            return
+
+        self.latencies.setdefault(name, collections.deque(maxlen=LATENCY_WINDOW)).append(trace_breakdown(trace))
+
+        latency = {}
+        for action, breakdowns in self.latencies.items():
+            stages = {}
+            for stage in TRACE_STAGES[1:] + ("total",):
+                values = [breakdown[stage] for breakdown in breakdowns if stage in breakdown]
+                if values:
+                    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+                    stages[stage] = {"p50": round(float(p50), 3), "p90": round(float(p90), 3), "p99": round(float(p99), 3), "max": max(values)}
+            latency[action] = {"count": len(breakdowns), "stages_ms": stages}
+
+        self.send_message("avr/fcm/action_latency", latency)  # type: ignore
+
 
 class ControlManager(FCMMQTTModule):
     # region ControlManager
-    def __init__(self) -> None:
+    def __init__(self, drone: Optional[mavsdk.System] = None) -> None:
         super().__init__()
 
-        # mavlink stuff
-        self.drone = mavsdk.System(sysid=141)
+        # mavlink stuff. A drone that is passed in is shared with the other
+        # managers, and is connected by its owner (see fcc_runtime.py)
+        self.owns_drone = drone is None
+        self.drone = drone or mavsdk.System(sysid=141)
 
-        # queues
-        self.action_queue = queue.Queue()
+        # actions arrive on the MQTT thread and are handed to the event loop
+        # with call_soon_threadsafe, both are set in run_non_blocking
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.action_queue: Optional[asyncio.Queue[Tuple[Dict[str, Any], dict]]] = None
+        # IDs of actions that do not bring their own
+        self.action_ids = itertools.count(1)
 
         self.topic_map = {
             "avr/fcm/actions": self.handle_action_message,
@@ -100,7 +390,14 @@ class ControlManager(FCMMQTTModule):
         self.curr_pos = {}
         self.curr_pos_init = False
 
-        self.target_pos = {"lat": math.nan, "lon": math.nan, "alt": math.nan}
+        # active goto, checked on every global position update. Altitude is
+        # relative to home, like the rel_alt of the position telemetry
+        self.goto_target: Optional[GotoTarget] = None
+
+        # hash of the mission on the drone, if it is the last one we uploaded
+        self.mission_hash: Optional[str] = None
+        # monotonic time our last upload finished, inf while uploading
+        self.mission_uploaded_at = -float("inf")
 
     async def connect(self) -> None:
         """
@@ -108,8 +405,15 @@ class ControlManager(FCMMQTTModule):
         """
         logger.debug("FCM Control: Connecting to the FCC")
 
-        # mavsdk does not support dns
-        await self.drone.connect(system_address="tcp://127.0.0.1:5761")
+        if self.owns_drone:
+            # mavsdk does not support dns
+            await self.drone.connect(system_address="tcp://127.0.0.1:5761")
+        else:
+            # reconnecting a shared drone would restart mavsdk_server from under
+            # the other managers, so just wait for the link to come up
+            async for connection_status in self.drone.core.connection_state():
+                if connection_status.is_connected:
+                    break
 
         logger.success("Connected to the FCC")
 
@@ -117,6 +421,10 @@ class ControlManager(FCMMQTTModule):
         """
         Run the Flight Control Computer module
         """
+        # created before the MQTT client starts so no action is missed
+        self.loop = asyncio.get_running_loop()
+        self.action_queue = asyncio.Queue()
+
         # start our MQTT client
         super().run_non_blocking()
 
@@ -127,7 +435,7 @@ class ControlManager(FCMMQTTModule):
         return asyncio.gather(
             # uncomment the following lines to enable outside control
             self.action_dispatcher(),
-            self.go_to_monitor(),
+            self.mission_changed_monitor(),
         )
 
     async def run(self) -> asyncio.Future:
@@ -136,38 +444,19 @@ class ControlManager(FCMMQTTModule):
             await asyncio.sleep(1)
 
     @async_try_except()
-    async def go_to_monitor(self) -> None:
-        while True:
-            # check if were actively chasing a target pos
-            if (not math.isnan(self.target_pos["lat"])) and self.curr_pos_init:
-                scalar_dist = await self.pos_norm(self.target_pos, self.curr_pos)
-                # if within .5m set to nans
-                if scalar_dist < 0.5:
-                    # we made it
-                    self.target_pos["lat"] = math.nan
-                    self.target_pos["lon"] = math.nan
-                    self.target_pos["alt"] = math.nan
-                    self._publish_event("goto_complete_event")
-            await asyncio.sleep(1)
-
-    async def pos_norm(self, lla_1: dict, lla_2: dict) -> np.floating[Any]:
-        n, e, d = pymap3d.geodetic2ned(
-            self.target_pos["lat"],
-            self.target_pos["lon"],
-            self.target_pos["alt"],
-            self.curr_pos["lat"],
-            self.curr_pos["lon"],
-            self.curr_pos["alt"],
-        )
-        # logger.debug(self.target_pos["lat"])
-        # logger.debug(self.target_pos["lon"])
-        # logger.debug(self.target_pos["alt"])
-        # logger.debug(self.curr_pos["lat"])
-        # logger.debug(self.curr_pos["lon"])
-        # logger.debug(self.curr_pos["alt"])
+    async def mission_changed_monitor(self) -> None:
+        """
+        Forgets the uploaded mission when the mission on the drone is changed
+        by anything else, such as QGroundControl.
+        """
+        async for changed in self.drone.mission_raw.mission_changed():
+            # PX4 acknowledging our own upload is reported as a change too
+            if time.monotonic() - self.mission_uploaded_at < 1:
+                continue
 
-        # logger.debug(f"FCM Control: (N: {n}) -- (E: {e}) -- (D: {d})")
-        return np.linalg.norm([n, e, d])
+            if changed and self.mission_hash is not None:
+                logger.info("FCM Control: mission changed on the drone")
+                self.mission_hash = None
 
     # region Telemetry
     def position_lla_telemetry(self, payload: dict) -> None:
@@ -181,6 +470,16 @@ class ControlManager(FCMMQTTModule):
             self.curr_pos_init = True
             logger.info("FCM Control: current position initialized")
 
+        # read once, the goto is started and cleared from the event loop
+        target = self.goto_target
+        if target is None or payload["lat"] is None:
+            return
+
+        if target.reached(payload["lat"], payload["lon"], payload["rel_alt"], time.monotonic()):
+            # we made it
+            self.goto_target = None
+            self._publish_event("goto_complete_event")
+
     def home_lla_telemetry(self, payload: dict) -> None:
         """
         Handles incoming Home LLA telemetry from MQTT
@@ -200,7 +499,19 @@ class ControlManager(FCMMQTTModule):
 
     # region Dispatcher
     def handle_action_message(self, payload: dict) -> None:
-        self.action_queue.put(payload)
+        """
+        Handles an action from MQTT. This is called from the MQTT thread, so the
+        action is put on the queue from the event loop, which wakes the
+        dispatcher immediately. Every action gets an ID, taken from its "id"
+        if it has one, and a latency trace.
+        """
+        trace = {"id": payload.get("id", next(self.action_ids)), "received": time.monotonic()}
+
+        if self.loop is None:
+            logger.warning(f"Dropping action received before the FCM started: {payload}")
+            return
+
+        self.loop.call_soon_threadsafe(self.action_queue.put_nowait, (trace, payload))  # type: ignore
 
     @async_try_except()
     async def action_dispatcher(self) -> None:
@@ -222,31 +533,30 @@ class ControlManager(FCMMQTTModule):
             "set_geofence": self.set_geofence,
         }
 
-        dispatcher = DispatcherManager()
+        # a safety action abandons the goto being watched
+        dispatcher = DispatcherManager(on_preempt=self.cancel_goto)
         dispatcher.run_non_blocking()
 
         while True:
             action = {}
             try:
-                action = self.action_queue.get_nowait()
+                trace, action = await self.action_queue.get()  # type: ignore
+                trace["dequeued"] = time.monotonic()
 
                 if action["payload"] == "":
-                    action["payload"] = "{}"
+                    action["payload"] = {}
 
                 if action["action"] in action_map:
                     # payload = json.loads(action["payload"])
                     payload = action["payload"]
-                    await dispatcher.schedule_task(action_map[action["action"]], payload, action["action"])
+                    await dispatcher.schedule_task(action_map[action["action"]], payload, action["action"], trace)
                 else:
-                    logger.warning(f"Unknown action: {action['name']}")
+                    logger.warning(f"Unknown action: {action['action']}")
 
             except DispatcherBusy:
-                logger.info("I'm busy running another task, try again later")
+                logger.info("I'm busy running other tasks and my backlog is full, try again later")
                 self._publish_event("fcc_busy_event", payload=action["action"])
 
-            except queue.Empty:
-                await asyncio.sleep(0.1)
-
             except Exception:
                 logger.exception("ERROR IN MAIN LOOP")
 
@@ -260,7 +570,9 @@ class ControlManager(FCMMQTTModule):
         state machine event given whether or not an `ActionError` was raised.
         """
         try:
+            mark_stage("command_sent", first=True)
             await action_fn()
+            mark_stage("acked")
             full_success_str = f"{action_text}_success_event"
             logger.info(f"Sending {full_success_str}")
             self._publish_event(full_success_str)
@@ -325,6 +637,7 @@ class ControlManager(FCMMQTTModule):
         Commands the drone computer to reboot.
         """
         logger.warning("Sending reboot command")
+        self.mission_hash = None
         await self.simple_action_executor(self.drone.action.reboot, "reboot")
 
     @async_try_except(reraise=True)
@@ -335,7 +648,9 @@ class ControlManager(FCMMQTTModule):
         """
         alt = kwargs["alt"]
         logger.info(f"Setting takeoff altitude to {alt}")
+        mark_stage("command_sent", first=True)
         await self.drone.action.set_takeoff_altitude(alt)
+        mark_stage("acked")
         await self.set_arm()
         logger.info("Sending takeoff command")
         await self.simple_action_executor(self.drone.action.takeoff, "takeoff")
@@ -361,21 +676,51 @@ class ControlManager(FCMMQTTModule):
             br_point = Point(min_lat, max_lon)
 
             fence = [Polygon([tl_point, tr_point, bl_point, br_point], Polygon.FenceType.INCLUSION)]
+            mark_stage("command_sent", first=True)
             await self.drone.geofence.upload_geofence(fence)
+            mark_stage("acked")
         except Exception as e:
             logger.error(e)
 
+    def cancel_goto(self) -> None:
+        """
+        Stops watching for the active goto to complete, so a goto that was
+        replaced, cancelled, or timed out never reports completion.
+        """
+        if self.goto_target is not None:
+            logger.info("FCM Control: goto cancelled")
+            self.goto_target = None
+
+    def start_goto(self, lat: float, lon: float, abs_alt: float, payload: dict) -> None:
+        """
+        Starts watching for a goto to complete. `acceptRadius` (m) and
+        `dwellTime` (s) in the action payload override the defaults.
+        """
+        # the position telemetry altitude is relative to home
+        rel_alt = abs_alt - self.home_pos["alt"] if self.home_pos_init else abs_alt
+
+        self.goto_target = GotoTarget(
+            lat,
+            lon,
+            rel_alt,
+            accept_radius=payload.get("acceptRadius", GOTO_ACCEPT_RADIUS),
+            dwell_time=payload.get("dwellTime", GOTO_DWELL_TIME),
+        )
+        self._publish_event("go_to_started_event")
+
     @async_try_except(reraise=True)
     async def goto_location(self, **kwargs) -> None:
         """
         Commands the drone to go to a location.
         """
         logger.warning("Sending go to location")
+        # watching only starts once PX4 accepts the goto, so if this action is
+        # cancelled or times out before then, nothing is left behind
+        self.cancel_goto()
+        mark_stage("command_sent", first=True)
         await self.drone.action.goto_location(kwargs["lat"], kwargs["lon"], kwargs["alt"], kwargs["heading"])
-        self.target_pos["lat"] = kwargs["lat"]
-        self.target_pos["lon"] = kwargs["lon"]
-        self.target_pos["alt"] = kwargs["alt"]
-        self._publish_event("go_to_started_event")
+        mark_stage("acked")
+        self.start_goto(kwargs["lat"], kwargs["lon"], kwargs["alt"], kwargs)
 
     @async_try_except(reraise=True)
     async def goto_location_ned(self, **kwargs) -> None:
@@ -404,155 +749,209 @@ class ControlManager(FCMMQTTModule):
 
         logger.info(f"Sending drone to Lat:{new_lat} Lon:{new_lon} Alt:{new_alt}")
 
+        self.cancel_goto()
+        mark_stage("command_sent", first=True)
         await self.drone.action.goto_location(new_lat, new_lon, new_alt, kwargs["heading"])
+        mark_stage("acked")
 
-        self.target_pos["lat"] = new_lat
-        self.target_pos["lon"] = new_lon
-        self.target_pos["alt"] = -1 * kwargs["d"]
-        self._publish_event("go_to_started_event")
+        self.start_goto(new_lat, new_lon, new_alt, kwargs)
 
     # endregion
 
     # region Missions
     @async_try_except(reraise=True)
     async def build(self, waypoints: List[dict]) -> List[MissionItem]:
-        """Convert a list of waypoints (dict) to a list of MissionItems."""
-        mission_items = []
+        """
+        Convert a list of waypoints (dict) to a list of MissionItems. The
+        waypoints are not modified, and all NED waypoints are converted to
+        lat/lon in one vectorized call.
+        """
+        # copies, so the caller's waypoints are left as they are
+        waypoints = [dict(waypoint) for waypoint in waypoints]
 
         # now, check if first waypoint has a lat/lon
         # and if not, add lat lon of current position
         waypoint_0 = waypoints[0]
-        if "lat" not in waypoints[0] or "lon" not in waypoints[0]:
+        if "lat" not in waypoint_0 or "lon" not in waypoint_0:
             # get the next update from the raw gps and use that
             # .position() only updates on new positions
             position = await self.drone.telemetry.raw_gps().__anext__()
             waypoint_0["lat"] = position.latitude_deg
             waypoint_0["lon"] = position.longitude_deg
 
-        # convert the dicts into mission_raw.MissionItems
-        for seq, waypoint in enumerate(waypoints):
-            waypoint_type = waypoint["type"]
-
-            # https://mavlink.io/en/messages/common.html#MISSION_ITEM_INT
-            command = None
-            param1 = None
-            param2 = None
-            param3 = None
-
-            if waypoint_type == "takeoff":
-                # https://mavlink.io/en/messages/common.html#MAV_CMD_NAV_TAKEOFF
-                # This takeoff command probably works, but missions without takeoff commands will just takeoff anyways.
-                # See these PX4 docs for what I'm talking about: https://docs.px4.io/main/en/flight_modes_mc/mission.html#mission-takeoff
-                command = mavutil.mavlink.MAV_CMD_NAV_TAKEOFF
-                param1 = 5  # pitch
-                param2 = float("nan")  # empty
-                param3 = float("nan")  # empty
-                param4 = waypoint["yaw"]  # yaw angle
-
-            elif waypoint_type == "goto":
-                # https://mavlink.io/en/messages/common.html#MAV_CMD_NAV_WAYPOINT
-                command = mavutil.mavlink.MAV_CMD_NAV_WAYPOINT
-                param1 = waypoint["holdTime"]  # hold time
-                param2 = waypoint["acceptRadius"]  # acceptance radius
-                param3 = 0  # 0 to pass through the WP, if > 0 radius to pass by WP. Positive value for clockwise orbit, negative value for counter-clockwise orbit. Allows trajectory control.
-                param4 = waypoint["yaw"]  # yaw angle, float("nan") to use the current system yaw heading mode (https://docs.px4.io/main/en/advanced_config/parameter_reference.html#MPC_YAW_MODE)
-
-            elif waypoint_type == "land":
-                # https://mavlink.io/en/messages/common.html#MAV_CMD_NAV_LAND
-                command = mavutil.mavlink.MAV_CMD_NAV_LAND
-                param1 = 0  # abort altitude, 0 uses system default
-                # https://mavlink.io/en/messages/common.html#PRECISION_LAND_MODE
-                param2 = mavutil.mavlink.PRECISION_LAND_MODE_DISABLED  # disable precision landing mode, we don't use beacons
-                param3 = float("nan")  # empty
-                param4 = waypoint["yaw"]  # yaw angle
-
-            elif waypoint_type == "loiter":
-                # https://mavlink.io/en/messages/common.html#MAV_CMD_NAV_LOITER_UNLIM
-                command = mavutil.mavlink.MAV_CMD_NAV_LOITER_UNLIM
-                param1 = float("nan")  # empty
-                param2 = float("nan")  # empty
-                param3 = 0  # Unused by multicopters
-                param4 = waypoint["yaw"]  # yaw angle
-
-            """
-            Package Delivery missions and corresponding gripper docs
-
-            Package delivery, gripper connection, PWM control docs:
-            https://docs.px4.io/main/en/flying/package_delivery_mission.html
-            https://docs.px4.io/main/en/peripherals/gripper.html#using-a-gripper
-            https://docs.px4.io/main/en/peripherals/gripper_servo.html
-
-            Gripper mission waypoint docs:
-            https://mavlink.io/en/messages/common.html#MAV_CMD_DO_GRIPPER
-
-            Image of FC connectivity (connect to FMU PWM??):
-            https://cdn-v2.getfpv.com/media/wysiwyg/Holybro_Pixhawk_6C_PM02_M9N_GPS_Plastic_Case_Info_1.webp
-            """
-
-            # https://mavlink.io/en/messages/common.html#MAV_FRAME
-            frame = mavutil.mavlink.MAV_FRAME_GLOBAL_INT
-            current = int(seq == 0)  # boolean
-            autocontinue = int(True)
+        for waypoint in waypoints:
+            if waypoint["type"] not in MISSION_COMMANDS:
+                raise ValueError(f"Unknown waypoint type '{waypoint['type']}'")
+
+        # lat/lon and altitude relative to home of every waypoint. A waypoint
+        # without NED fields must have a lat/lon and alt, like the old
+        # per-waypoint loop
+        ned = np.array([any(x in waypoint.keys() for x in ["n", "e", "d"]) for waypoint in waypoints])
+        lat = np.array([np.nan if is_ned else float(waypoint["lat"]) for waypoint, is_ned in zip(waypoints, ned)])
+        lon = np.array([np.nan if is_ned else float(waypoint["lon"]) for waypoint, is_ned in zip(waypoints, ned)])
+        rel_alt = np.array([np.nan if is_ned else float(waypoint["alt"]) for waypoint, is_ned in zip(waypoints, ned)])
+
+        if ned.any():
+            n, e, d = np.array([[waypoint["n"], waypoint["e"], waypoint["d"]] for waypoint, is_ned in zip(waypoints, ned) if is_ned], dtype=float).T
+            lat[ned], lon[ned], abs_alt = pymap3d.ned2geodetic(
+                n,
+                e,
+                d,
+                self.home_pos["lat"],
+                self.home_pos["lon"],
+                self.home_pos["alt"],
+            )
+            rel_alt[ned] = abs_alt - self.home_pos["alt"]
 
-            if any(x in waypoint.keys() for x in ["n", "e", "d"]):
-                waypoint["lat"], waypoint["lon"], new_alt = pymap3d.ned2geodetic(
-                    waypoint["n"],
-                    waypoint["e"],
-                    waypoint["d"],
-                    self.home_pos["lat"],
-                    self.home_pos["lon"],
-                    self.home_pos["alt"],
-                )
-                waypoint["alt"] = float(new_alt - self.home_pos["alt"])  # this is.. weird but sets up the next section to be able to reuse code
-            x = int(float(waypoint["lat"]) * 10000000)
-            y = int(float(waypoint["lon"]) * 10000000)
-            z = float(waypoint["alt"]) + self.home_pos["alt"]
-            # https://mavlink.io/en/messages/common.html#MAV_MISSION_TYPE
-            mission_type = mavutil.mavlink.MAV_MISSION_TYPE_MISSION
+        # a NaN would be cast to a garbage int64 below, where the old loop's
+        # int() raised
+        invalid = np.flatnonzero(np.isnan(lat) | np.isnan(lon) | np.isnan(rel_alt))
+        if invalid.size:
+            raise ValueError(f"Waypoints {invalid.tolist()} have no valid lat/lon/alt")
+
+        # https://mavlink.io/en/messages/common.html#MISSION_ITEM_INT
+        x = (lat * 10000000).astype(np.int64).tolist()
+        y = (lon * 10000000).astype(np.int64).tolist()
+        z = (rel_alt + self.home_pos["alt"]).tolist()
+
+        """
+        Package Delivery missions and corresponding gripper docs
+
+        Package delivery, gripper connection, PWM control docs:
+        https://docs.px4.io/main/en/flying/package_delivery_mission.html
+        https://docs.px4.io/main/en/peripherals/gripper.html#using-a-gripper
+        https://docs.px4.io/main/en/peripherals/gripper_servo.html
+
+        Gripper mission waypoint docs:
+        https://mavlink.io/en/messages/common.html#MAV_CMD_DO_GRIPPER
+
+        Image of FC connectivity (connect to FMU PWM??):
+        https://cdn-v2.getfpv.com/media/wysiwyg/Holybro_Pixhawk_6C_PM02_M9N_GPS_Plastic_Case_Info_1.webp
+        """
+
+        # https://mavlink.io/en/messages/common.html#MAV_FRAME
+        frame = mavutil.mavlink.MAV_FRAME_GLOBAL_INT
+        # https://mavlink.io/en/messages/common.html#MAV_MISSION_TYPE
+        mission_type = mavutil.mavlink.MAV_MISSION_TYPE_MISSION
+        autocontinue = int(True)
+
+        mission_items = []
+        for seq, waypoint in enumerate(waypoints):
+            command, params = MISSION_COMMANDS[waypoint["type"]]
+            param1, param2, param3, param4 = params(waypoint)
 
             mission_items.append(
                 MissionItem(
                     seq=seq,
                     frame=frame,
                     command=command,
-                    current=current,
+                    current=int(seq == 0),  # boolean
                     autocontinue=autocontinue,
                     param1=param1,
                     param2=param2,
                     param3=param3,
                     param4=param4,
-                    x=x,
-                    y=y,
-                    z=z,
+                    x=x[seq],
+                    y=y[seq],
+                    z=z[seq],
                     mission_type=mission_type,
                 )
             )
 
         return mission_items
 
+    def optimize_mission(self, waypoints: List[dict]) -> List[dict]:
+        """
+        Reorders the goto waypoints of a mission for the shortest estimated
+        flight time (see fcc_mission.py), and publishes the estimated time
+        saved in seconds as a mission_optimized_event.
+        """
+        if not self.home_pos_init:
+            logger.warning("FCM Control: home position unknown, not optimizing mission")
+            return waypoints
+
+        # NED position of every waypoint relative to home, a first waypoint
+        # without a lat/lon starts from the current position. Like build, a
+        # waypoint without NED fields must have an alt
+        positions = np.full((len(waypoints), 3), np.nan)
+        geodetic = {}
+        for i, waypoint in enumerate(waypoints):
+            if any(x in waypoint.keys() for x in ["n", "e", "d"]):
+                positions[i] = [waypoint["n"], waypoint["e"], waypoint["d"]]
+            elif "lat" in waypoint and "lon" in waypoint:
+                geodetic[i] = (waypoint["lat"], waypoint["lon"], waypoint["alt"])
+            elif i == 0 and self.curr_pos_init:
+                geodetic[i] = (self.curr_pos["lat"], self.curr_pos["lon"], waypoint["alt"])
+
+        if geodetic:
+            lat, lon, alt = np.array(list(geodetic.values()), dtype=float).T
+            positions[list(geodetic)] = np.column_stack(
+                pymap3d.geodetic2ned(
+                    lat,
+                    lon,
+                    alt + self.home_pos["alt"],
+                    self.home_pos["lat"],
+                    self.home_pos["lon"],
+                    self.home_pos["alt"],
+                )
+            )
+
+        if np.isnan(positions).any():
+            logger.warning("FCM Control: not every waypoint has a position, not optimizing mission")
+            return waypoints
+
+        optimized, before, after = optimize_waypoints(waypoints, positions)
+        logger.info(f"FCM Control: optimized mission from {before:.1f} s to {after:.1f} s")
+        self._publish_event("mission_optimized_event", f"{before - after:.1f}")
+        return optimized
+
     @async_try_except(reraise=True)
-    async def upload(self, mission_items: List[MissionItem]) -> None:
+    async def upload(self, mission_items: List[MissionItem], force: bool = False) -> None:
         """
-        Upload a given list of MissionItems to the drone.
+        Upload a given list of MissionItems to the drone. If the drone already
+        has the same mission from the last upload, only the mission is rewound
+        to the first item, unless `force` is set.
         """
+        digest = mission_hash(mission_items)
+
         try:
-            logger.info("Clearing existing mission on the drone")
-            await self.drone.mission_raw.clear_mission()
-            logger.info("Uploading mission items to drone")
+            if not force and digest == self.mission_hash:
+                logger.info(f"Mission {digest[:8]} is already on the drone, skipping upload")
+                mark_stage("command_sent", first=True)
+                await self.drone.mission_raw.set_current_mission_item(0)
+                mark_stage("acked")
+                self._publish_event("mission_upload_success_event", "unchanged")
+                return
+
+            # the upload replaces the whole mission, so there is no need to
+            # clear it first
+            logger.info(f"Uploading mission {digest[:8]} ({len(mission_items)} items) to drone")
+            self.mission_hash = None
+            self.mission_uploaded_at = float("inf")
+            mark_stage("command_sent", first=True)
             await self.drone.mission_raw.upload_mission(mission_items)
+            mark_stage("acked")
+            self.mission_hash = digest
             self._publish_event("mission_upload_success_event")
             logger.info("Mission Upload SUCCESS")
         except MissionRawError as e:
             logger.warning(f"Mission upload failed because: {e._result.result_str}")
+            self.mission_hash = None
             self._publish_event("mission_upload_failed_event", str(e._result.result_str))
+        finally:
+            self.mission_uploaded_at = min(self.mission_uploaded_at, time.monotonic())
 
     @async_try_except(reraise=True)
     async def build_and_upload(self, **kwargs) -> None:
         """
         Upload a list of waypoints (dict) to the done.
         """
-        mission_plan = await self.build(kwargs["waypoints"])
-        await self.upload(mission_plan)
+        waypoints = kwargs["waypoints"]
+        if kwargs.get("optimize", False):
+            waypoints = self.optimize_mission(waypoints)
+
+        mission_plan = await self.build(waypoints)
+        await self.upload(mission_plan, force=kwargs.get("force", False))
         # Removed the set_geofence because QGC should handle that stuff
         # await self.set_geofence(min_lat=-90, min_lon=-180, max_lat=90, max_lon=180)
 
@@ -564,7 +963,9 @@ class ControlManager(FCMMQTTModule):
         Will raise an exception if the active mission violates a geofence.
         """
         logger.info("Sending start mission command")
+        mark_stage("command_sent", first=True)
         await self.drone.mission_raw.start_mission()
+        mark_stage("acked")
 
     # endregion Missions
 
@@ -1,13 +1,50 @@
-import threading
-import time
+import asyncio
+from typing import Any, Callable, Optional, Tuple
 
 from bell.avr.mqtt.payloads import AvrFcmHilGpsStatsPayload, AvrFusionHilGpsPayload
-from bell.avr.utils.decorators import try_except
+from bell.avr.utils.decorators import async_try_except, try_except
 from bell.avr.utils.timing import rate_limit
 from fcc_mqtt import FCMMQTTModule
 from loguru import logger
 from pymavlink import mavutil
 
+# this NEEDS to be using UDP, TCP proved extremely unreliable
+HIL_GPS_ADDRESS = ("127.0.0.1", 14541)
+
+# HIL_GPS_HEADING is only in the bell dialect
+mavutil.set_dialect("bell")
+
+
+class MAVLinkDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Minimal MAVLink connection on an asyncio UDP transport, equivalent to a
+    pymavlink `udpout` connection. Messages are encoded and decoded with the
+    pymavlink dialect, and every received message is passed to `on_mavlink`.
+    """
+
+    def __init__(self, source_system: int, source_component: int, on_mavlink: Callable[[Any], None]) -> None:
+        self.mav = mavutil.mavlink.MAVLink(self, srcSystem=source_system, srcComponent=source_component)
+        self.on_mavlink = on_mavlink
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport  # type: ignore
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        for msg in self.mav.parse_buffer(data) or []:
+            self.on_mavlink(msg)
+
+    def error_received(self, exc: Exception) -> None:
+        # nothing is listening yet, PX4 will pick up the next heartbeat
+        logger.debug(f"HIL_GPS: {exc}")
+
+    def write(self, buf: bytes) -> None:
+        """
+        Called by the pymavlink encoder to send a packed message.
+        """
+        if self.transport is not None:
+            self.transport.sendto(buf)
+
 
 class HILGPSManager(FCMMQTTModule):
     def __init__(self) -> None:
@@ -19,53 +56,82 @@ class HILGPSManager(FCMMQTTModule):
 
         self.num_frames = 0
 
-    @try_except()
-    def heartbeat(self) -> None:
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.mavcon: Optional[MAVLinkDatagramProtocol] = None
+        self.heartbeat_received: Optional[asyncio.Event] = None
+
+        # RC channel 6 magnet control state
+        self.rc_default_val = 1514  # value that the channel broadcasts when the knob is not being actuated (estimated)
+        self.rc_last_val = 0
+        self.rc_log_val_thres = 30
+        self.rc_action_val_thres = 100
+
+    @async_try_except()
+    async def heartbeat(self) -> None:
         while True:
-            self.mavcon.mav.heartbeat_send(
+            self.mavcon.mav.heartbeat_send(  # type: ignore
                 mavutil.mavlink.MAV_TYPE_ONBOARD_CONTROLLER,
                 mavutil.mavlink.MAV_AUTOPILOT_INVALID,
                 0,
                 0,
                 0,
             )
-            time.sleep(1)
+            await asyncio.sleep(1)
 
-    @try_except()
-    def run_non_blocking(self) -> None:
+    async def run_non_blocking(self) -> None:
         """
         Set up a mavlink connection and kick off any tasks
         """
+        self.loop = asyncio.get_running_loop()
+
+        # created here so the event belongs to the running loop
+        self.heartbeat_received = asyncio.Event()
 
-        # this NEEDS to be using UDP, TCP proved extremely unreliable
-        self.mavcon: mavutil.mavudp = mavutil.mavlink_connection(
-            "udpout:127.0.0.1:14541",
-            source_system=143,
-            source_component=190,
-            dialect="bell",
+        _, self.mavcon = await self.loop.create_datagram_endpoint(
+            lambda: MAVLinkDatagramProtocol(143, 190, self.on_mavlink),
+            remote_addr=HIL_GPS_ADDRESS,
         )
 
-        heartbeat_thread = threading.Thread(target=self.heartbeat)
-        heartbeat_thread.daemon = True
-        heartbeat_thread.start()
+        self.loop.create_task(self.heartbeat())
 
         logger.debug("HIL_GPS: Waiting for Mavlink heartbeat")
 
-        self.mavcon.wait_heartbeat()
+        await self.heartbeat_received.wait()
 
         logger.success("HIL_GPS: Mavlink heartbeat received")
 
-        rc_control_thread = threading.Thread(target=self.RC_magnet_control)
-        rc_control_thread.daemon = True
-        rc_control_thread.start()
-
         super().run_non_blocking()
 
-    @try_except(reraise=True)
+        logger.info("Monitoring RC input in fcc_hil_gps.py")
+        self.send_message("avr/pcm/set_magnet", {"enabled": False})  # type: ignore
+
+    async def run(self) -> None:
+        await self.run_non_blocking()
+        while True:
+            await asyncio.sleep(1)
+
+    @try_except()
+    def on_mavlink(self, msg: Any) -> None:
+        """
+        Handles every MAVLink message received from PX4.
+        """
+        msg_type = msg.get_type()
+
+        if msg_type == "HEARTBEAT":
+            self.heartbeat_received.set()  # type: ignore
+        elif msg_type == "RC_CHANNELS" and self.heartbeat_received.is_set():  # type: ignore
+            self.RC_magnet_control(msg)
+
     def hilgps_msg_handler(self, payload: AvrFusionHilGpsPayload) -> None:
         """
-        Handle a HIL_GPS message.
+        Handle a HIL_GPS message. This is called from the MQTT thread, so the
+        message is sent from the event loop, which owns the transport.
         """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.send_hil_gps, payload)
+
+    @try_except(reraise=True)
+    def send_hil_gps(self, payload: AvrFusionHilGpsPayload) -> None:
         msg = self.mavcon.mav.hil_gps_heading_encode(  # type: ignore
             payload["time_usec"],
             payload["fix_type"],
@@ -95,44 +161,28 @@ class HILGPSManager(FCMMQTTModule):
             frequency=1,
         )
 
-    def RC_magnet_control(self):
+    def RC_magnet_control(self, msg: Any) -> None:
         """Monitors RC channel 6 (currently bound to VrB, or the right knob)
         for significant changes and performs actions based on the channel value.
 
-        This method continuously listens for RC_CHANNELS messages and monitors the value of channel 6.
+        This method is called for every RC_CHANNELS message and checks the value of channel 6.
         If the value changes significantly from the last logged value, it logs the new value.
         Additionally, it enables or disables a magnet based on the channel value relative to a default value.
         """
-        DEFAULT_VAL = 1514  # value that the channel broadcasts when the knob is not being actuated (estimated)
-        last_val = 0
-        log_val_thres = 30
-        action_val_thres = 100
-        logger.info("Monitoring RC input in fcc_hil_gps.py")
-        self.send_message("avr/pcm/set_magnet", {"enabled": False})
-        while True:
-            # wait for a message
-            msg = self.mavcon.recv_match(type="RC_CHANNELS", blocking=True)
-
-            # if the message is not None, then we have a value for channel 6
-            if msg:
-                cur_value = msg.chan6_raw
-            else:
-                continue
+        cur_value = msg.chan6_raw
 
-            # log the value if it has changed significantly
-            if cur_value > last_val + log_val_thres or cur_value < last_val - log_val_thres:
-                logger.debug(f"Channel 6: {cur_value}")
-                last_val = cur_value
+        # log the value if it has changed significantly
+        if cur_value > self.rc_last_val + self.rc_log_val_thres or cur_value < self.rc_last_val - self.rc_log_val_thres:
+            logger.debug(f"Channel 6: {cur_value}")
+            self.rc_last_val = cur_value
 
-            # if the value is above or below a certain threshold, then either enable or disable the magnet
-            if cur_value > DEFAULT_VAL + action_val_thres:
-                self.send_message("avr/pcm/set_magnet", {"enabled": True})
-            elif cur_value < DEFAULT_VAL - action_val_thres:
-                self.send_message("avr/pcm/set_magnet", {"enabled": False})
+        # if the value is above or below a certain threshold, then either enable or disable the magnet
+        if cur_value > self.rc_default_val + self.rc_action_val_thres:
+            self.send_message("avr/pcm/set_magnet", {"enabled": True})  # type: ignore
+        elif cur_value < self.rc_default_val - self.rc_action_val_thres:
+            self.send_message("avr/pcm/set_magnet", {"enabled": False})  # type: ignore
 
 
 if __name__ == "__main__":
     gps = HILGPSManager()
-    gps.run_non_blocking()
-    while True:
-        time.sleep(0.1)
+    asyncio.run(gps.run())
@@ -0,0 +1,171 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# PX4 multicopter defaults for mission flight, in m/s: MPC_XY_CRUISE,
+# MPC_Z_V_AUTO_UP, and MPC_Z_V_AUTO_DN
+DEFAULT_SPEEDS = {"horizontal": 5.0, "up": 3.0, "down": 1.5}
+
+# waypoint types that keep their place in the mission. Only goto waypoints
+# between them are reordered
+ANCHOR_TYPES = ("takeoff", "land", "loiter")
+
+
+def leg_times(positions: np.ndarray, speeds: Optional[Dict[str, float]] = None) -> np.ndarray:
+    """
+    Returns the estimated flight time (s) between every pair of NED positions
+    (N x 3), as an N x N matrix where [i, j] is the time from i to j. PX4 flies
+    the horizontal and vertical parts of a leg at the same time, so a leg takes
+    as long as the slower of the two.
+    """
+    speeds = speeds or DEFAULT_SPEEDS
+
+    delta = positions[np.newaxis, :, :] - positions[:, np.newaxis, :]
+    horizontal = np.hypot(delta[:, :, 0], delta[:, :, 1]) / speeds["horizontal"]
+    # down is positive, so a negative delta is a climb
+    vertical = np.where(delta[:, :, 2] < 0, -delta[:, :, 2] / speeds["up"], delta[:, :, 2] / speeds["down"])
+
+    return np.maximum(horizontal, vertical)
+
+
+def route_time(route: List[int], times: np.ndarray) -> float:
+    """
+    Total flight time of the legs of a route.
+    """
+    return float(times[route[:-1], route[1:]].sum())
+
+
+def nearest_neighbor(times: np.ndarray, start: int, free: List[int], end: int) -> List[int]:
+    """
+    Builds a route from start to end through the free points by always flying
+    to the closest point not yet visited.
+    """
+    route = [start]
+    remaining = list(free)
+    while remaining:
+        nearest = min(remaining, key=lambda point: times[route[-1], point])
+        route.append(nearest)
+        remaining.remove(nearest)
+    route.append(end)
+    return route
+
+
+def two_opt(route: List[int], times: np.ndarray) -> bool:
+    """
+    Applies the first 2-opt move (reversing a run of points) that shortens the
+    route, and returns whether there was one. Leg times can differ by
+    direction, so the reversed run is costed in reverse.
+    """
+    points = np.array(route)
+    forward = times[points[:-1], points[1:]]
+    backward = times[points[1:], points[:-1]]
+    # cumulative times, so the time of any run of legs is a subtraction
+    forward_sum = np.concatenate(([0.0], np.cumsum(forward)))
+    backward_sum = np.concatenate(([0.0], np.cumsum(backward)))
+
+    for i in range(len(route) - 3):
+        # reverse route[i + 1 : j + 1], for every j at once
+        j = np.arange(i + 2, len(route) - 1)
+        before = forward[i] + forward[j] + forward_sum[j] - forward_sum[i + 1]
+        after = times[points[i], points[j]] + times[points[i + 1], points[j + 1]] + backward_sum[j] - backward_sum[i + 1]
+
+        best = int(np.argmax(before - after))
+        if before[best] - after[best] > 1e-9:
+            end = int(j[best]) + 1
+            route[i + 1 : end] = route[i + 1 : end][::-1]
+            return True
+
+    return False
+
+
+def or_opt(route: List[int], times: np.ndarray, max_length: int = 3) -> bool:
+    """
+    Applies the first Or-opt move (moving a run of up to `max_length` points
+    elsewhere in the route, keeping its direction) that shortens the route,
+    and returns whether there was one.
+    """
+    points = np.array(route)
+    legs = times[points[:-1], points[1:]]
+
+    for length in range(1, max_length + 1):
+        for i in range(1, len(route) - length):
+            first, last = route[i], route[i + length - 1]
+            prev, after = route[i - 1], route[i + length]
+            removed = times[prev, first] + times[last, after] - times[prev, after]
+
+            # insert between route[j] and route[j + 1], for every j outside the run
+            j = np.arange(len(route) - 1)
+            j = j[(j < i - 1) | (j >= i + length)]
+            added = times[points[j], first] + times[last, points[j + 1]] - legs[j]
+            if not len(j):
+                continue
+
+            best = int(np.argmin(added))
+            if added[best] < removed - 1e-9:
+                segment = route[i : i + length]
+                rest = route[:i] + route[i + length :]
+                insert = int(j[best]) + 1 if j[best] < i else int(j[best]) + 1 - length
+                route[:] = rest[:insert] + segment + rest[insert:]
+                return True
+
+    return False
+
+
+def optimize_route(times: np.ndarray, start: int, free: List[int], end: int) -> List[int]:
+    """
+    Orders the free points of a route between fixed start and end points for
+    the shortest flight time, with nearest neighbor followed by 2-opt and
+    Or-opt until neither improves it.
+    """
+    route = nearest_neighbor(times, start, free, end)
+    while two_opt(route, times) or or_opt(route, times):
+        pass
+    return route
+
+
+def anchors(waypoints: List[dict]) -> List[int]:
+    """
+    Indices of the waypoints that keep their place: the first and last
+    waypoints, takeoff, land, and loiter waypoints, the goto right before a
+    land (its approach), and any waypoint with `"fixed": true`.
+    """
+    fixed = {0, len(waypoints) - 1}
+    for i, waypoint in enumerate(waypoints):
+        if waypoint["type"] in ANCHOR_TYPES or waypoint.get("fixed", False):
+            fixed.add(i)
+        if waypoint["type"] == "land" and i > 0:
+            fixed.add(i - 1)
+    return sorted(fixed)
+
+
+def optimize_waypoints(waypoints: List[dict], positions: np.ndarray, speeds: Optional[Dict[str, float]] = None) -> Tuple[List[dict], float, float]:
+    """
+    Reorders the goto waypoints between anchors (see `anchors`) for the
+    shortest estimated flight time. `positions` are the NED positions of the
+    waypoints (N x 3). Returns the reordered waypoints, and the estimated
+    mission time (s) before and after, including hold times. If no faster order
+    is found, the waypoints are returned in their original order.
+
+    Every waypoint is visited exactly once in any order, so hold times add the
+    same total to every route. They are left out of the ordering and only added
+    to the reported mission times.
+    """
+    times = leg_times(positions, speeds)
+    fixed = anchors(waypoints)
+
+    order = [fixed[0]]
+    for start, end in zip(fixed[:-1], fixed[1:]):
+        free = list(range(start + 1, end))
+        order += optimize_route(times, start, free, end)[1:] if len(free) > 1 else free + [end]
+
+    # the same for every order, see above
+    holds = sum(float(waypoint.get("holdTime", 0) or 0) for waypoint in waypoints)
+    before = route_time(list(range(len(waypoints))), times) + holds
+    after = route_time(order, times) + holds
+
+    # the heuristics can miss an order that is already optimal, never hand back
+    # a route that is no faster than the one given
+    if after >= before:
+        return list(waypoints), before, before
+
+    return [waypoints[i] for i in order], before, after
@@ -0,0 +1,285 @@
+import asyncio
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import mavsdk
+from bell.avr.utils.decorators import async_try_except, try_except
+from fcc_mqtt import FCMMQTTModule
+from fcc_streams import StreamStats
+from loguru import logger
+from mavsdk.offboard import (
+    OffboardError,
+    PositionNedYaw,
+    VelocityBodyYawspeed,
+    VelocityNedYaw,
+)
+
+# rate setpoints are streamed to PX4 at, and the range it can be set in. PX4
+# drops out of offboard when setpoints arrive slower than 2 Hz, so the floor
+# keeps a margin above that, 20 Hz keeps control loops tight, and more than
+# 50 Hz only loads the link
+OFFBOARD_RATE_HZ = 20.0
+OFFBOARD_MIN_RATE_HZ = 5.0
+OFFBOARD_MAX_RATE_HZ = 50.0
+
+# seconds without a new setpoint from MQTT before offboard is stopped and the
+# drone switches to hold
+OFFBOARD_WATCHDOG_S = 0.5
+
+# setpoint frame: (mavsdk offboard method, setpoint builder from the payload)
+SETPOINT_FRAMES: Dict[str, Tuple[str, Callable[[dict], Any]]] = {
+    "position_ned": ("set_position_ned", lambda p: PositionNedYaw(p["n"], p["e"], p["d"], p["yaw"])),
+    "velocity_ned": ("set_velocity_ned", lambda p: VelocityNedYaw(p["vn"], p["ve"], p["vd"], p["yaw"])),
+    "velocity_body": ("set_velocity_body", lambda p: VelocityBodyYawspeed(p["forward"], p["right"], p["down"], p["yaw_rate"])),
+}
+
+
+def hold_setpoint() -> Tuple[str, Any]:
+    """
+    Setpoint that keeps the drone where it is, without turning.
+    """
+    return "velocity_body", VelocityBodyYawspeed(0.0, 0.0, 0.0, 0.0)
+
+
+class OffboardManager(FCMMQTTModule):
+    """
+    Streams position, velocity, or yaw rate setpoints from MQTT to PX4 in
+    offboard mode at a fixed rate. The latest setpoint is resent every cycle,
+    and if no new setpoint arrives within the watchdog time, offboard is stopped
+    and PX4 switches to hold.
+    """
+
+    def __init__(self, drone: Optional[mavsdk.System] = None, rate_hz: float = OFFBOARD_RATE_HZ, watchdog_s: float = OFFBOARD_WATCHDOG_S) -> None:
+        super().__init__()
+
+        if not OFFBOARD_MIN_RATE_HZ <= rate_hz <= OFFBOARD_MAX_RATE_HZ:
+            raise ValueError(f"Offboard rate must be between {OFFBOARD_MIN_RATE_HZ} and {OFFBOARD_MAX_RATE_HZ} Hz")
+
+        # mavlink stuff. A drone that is passed in is shared with the other
+        # managers, and is connected by its owner (see fcc_runtime.py)
+        self.owns_drone = drone is None
+        self.drone = drone or mavsdk.System(sysid=144)
+
+        self.rate_hz = rate_hz
+        self.watchdog_s = watchdog_s
+
+        self.topic_map = {
+            "avr/fcm/offboard/setpoint": self.setpoint_msg_handler,
+            "avr/fcm/offboard/enable": self.enable_msg_handler,
+            "avr/fcm/status": self.status_msg_handler,
+        }
+
+        # MQTT messages arrive on the MQTT thread and are handed to the event
+        # loop, which owns all of the state below
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # latest setpoint, and the monotonic time it was received
+        self.frame, self.setpoint = hold_setpoint()
+        self.setpoint_time = -float("inf")
+
+        # offboard was requested over MQTT, and setpoints are being streamed
+        self.requested = False
+        self.active = False
+        self.fcc_mode = "UNKNOWN"
+
+        self.received_stats = StreamStats(max_rate_hz=OFFBOARD_MAX_RATE_HZ)
+        self.sent_stats = StreamStats(max_rate_hz=OFFBOARD_MAX_RATE_HZ)
+        self.failsafes = 0
+
+    async def connect(self) -> None:
+        """
+        Connect the Drone object.
+        """
+        logger.debug("Offboard: Connecting to the FCC")
+
+        if self.owns_drone:
+            # mavsdk does not support dns
+            await self.drone.connect(system_address="tcp://127.0.0.1:5761")
+        else:
+            # reconnecting a shared drone would restart mavsdk_server from under
+            # the other managers, so just wait for the link to come up
+            async for connection_status in self.drone.core.connection_state():
+                if connection_status.is_connected:
+                    break
+
+        logger.success("Offboard: Connected to the FCC")
+
+    async def run_non_blocking(self) -> asyncio.Future:
+        """
+        Run the offboard module
+        """
+        # set before the MQTT client starts so no setpoint is missed
+        self.loop = asyncio.get_running_loop()
+
+        # start our MQTT client
+        super().run_non_blocking()
+
+        # connect to the fcc
+        await self.connect()
+
+        # start tasks
+        return asyncio.gather(
+            self.offboard_loop(),
+            self.stats_publisher(),
+        )
+
+    async def run(self) -> asyncio.Future:
+        asyncio.gather(self.run_non_blocking())
+        while True:
+            await asyncio.sleep(1)
+
+    # region MQTT
+    def setpoint_msg_handler(self, payload: dict) -> None:
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.set_setpoint, payload)
+
+    def enable_msg_handler(self, payload: dict) -> None:
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.set_requested, payload["enabled"])
+
+    def status_msg_handler(self, payload: dict) -> None:
+        if self.loop is not None and "mode" in payload:
+            self.loop.call_soon_threadsafe(self.set_fcc_mode, payload["mode"])
+
+    @try_except()
+    def set_setpoint(self, payload: dict) -> None:
+        """
+        Stores a setpoint from MQTT, to be sent on the next cycle.
+        """
+        frame = payload["frame"]
+        if frame not in SETPOINT_FRAMES:
+            logger.warning(f"Offboard: unknown setpoint frame '{frame}'")
+            return
+
+        self.setpoint = SETPOINT_FRAMES[frame][1](payload)
+        self.frame = frame
+        self.setpoint_time = time.monotonic()
+        self.received_stats.record(self.setpoint_time)
+
+    def set_requested(self, enabled: bool) -> None:
+        """
+        Requests offboard to start on the next cycle, or stops it.
+        """
+        if enabled and not self.requested:
+            logger.info("Offboard: requested")
+            # until a setpoint arrives, hold in place, and give the sender a
+            # full watchdog period to start streaming
+            if time.monotonic() - self.setpoint_time > self.watchdog_s:
+                self.frame, self.setpoint = hold_setpoint()
+                self.setpoint_time = time.monotonic()
+
+        self.requested = enabled
+
+    def set_fcc_mode(self, mode: str) -> None:
+        """
+        Tracks the flight mode, so leaving offboard from the RC or another
+        action (such as land or kill) stops the setpoint stream.
+        """
+        if self.active and self.fcc_mode == "OFFBOARD" and mode != "OFFBOARD":
+            logger.warning(f"Offboard: PX4 switched to {mode}, no longer streaming setpoints")
+            self.active = False
+            self.requested = False
+            self._publish_event("offboard_exited_event", mode)
+        self.fcc_mode = mode
+
+    # endregion
+
+    # region Offboard
+    @async_try_except()
+    async def offboard_loop(self) -> None:
+        """
+        Starts, streams, and stops offboard at the fixed rate.
+        """
+        period = 1 / self.rate_hz
+        next_cycle = time.monotonic()
+
+        logger.debug("offboard loop started")
+        while True:
+            try:
+                if self.requested and not self.active:
+                    await self.start_offboard()
+                elif self.active and not self.requested:
+                    await self.stop_offboard()
+                    self._publish_event("offboard_stopped_event")
+                elif self.active:
+                    if time.monotonic() - self.setpoint_time > self.watchdog_s:
+                        logger.warning(f"Offboard: no setpoint for {self.watchdog_s} s, holding")
+                        self.failsafes += 1
+                        self.requested = False
+                        await self.stop_offboard()
+                        self._publish_event("offboard_failsafe_event")
+                    else:
+                        await self.send_setpoint()
+
+            except Exception:
+                logger.exception("ERROR IN OFFBOARD LOOP")
+
+            # keep a fixed rate, but skip missed cycles instead of bursting
+            next_cycle += period
+            now = time.monotonic()
+            if next_cycle < now:
+                next_cycle = now
+            await asyncio.sleep(next_cycle - now)
+
+    async def send_setpoint(self) -> None:
+        await getattr(self.drone.offboard, SETPOINT_FRAMES[self.frame][0])(self.setpoint)
+        self.sent_stats.record()
+
+    async def start_offboard(self) -> None:
+        """
+        Starts offboard. PX4 only accepts offboard while setpoints are already
+        being received, so one is sent first.
+        """
+        try:
+            await self.send_setpoint()
+            await self.drone.offboard.start()
+            self.active = True
+            logger.success("Offboard: started")
+            self._publish_event("offboard_started_event")
+
+        except OffboardError as e:
+            logger.warning(f"Offboard: could not start: {e._result.result_str}")
+            self.requested = False
+            self._publish_event("offboard_start_failed_event", str(e._result.result_str))
+
+    async def stop_offboard(self) -> None:
+        """
+        Stops offboard, which puts PX4 in hold.
+        """
+        self.active = False
+        try:
+            await self.drone.offboard.stop()
+            logger.info("Offboard: stopped")
+
+        except OffboardError as e:
+            # make sure the drone does not keep flying on the last setpoint
+            logger.warning(f"Offboard: could not stop: {e._result.result_str}, sending hold")
+            await self.drone.action.hold()
+
+    @async_try_except()
+    async def stats_publisher(self) -> None:
+        """
+        Publishes the setpoint rates every second.
+        """
+        while True:
+            await asyncio.sleep(1)
+
+            now = time.monotonic()
+            self.send_message(  # type: ignore
+                "avr/fcm/offboard/stats",
+                {
+                    "active": self.active,
+                    "frame": self.frame,
+                    "setpoint_age_s": round(now - self.setpoint_time, 3) if self.setpoint_time > 0 else None,
+                    "received": self.received_stats.stats(now),
+                    "sent": self.sent_stats.stats(now),
+                    "failsafes": self.failsafes,
+                },
+            )
+
+    # endregion
+
+
+if __name__ == "__main__":
+    offboard = OffboardManager()
+    asyncio.run(offboard.run())
@@ -0,0 +1,57 @@
+import asyncio
+
+import mavsdk
+from fcc_control import ControlManager
+from fcc_hil_gps import HILGPSManager
+from fcc_offboard import OffboardManager
+from fcc_telemetry import TelemetryManager
+from loguru import logger
+
+
+class FCMRuntime:
+    """
+    Runs telemetry, control, offboard, and HIL GPS in a single process on one
+    asyncio event loop. Telemetry, control, and offboard share one mavsdk
+    System, and so one mavsdk_server and one MAVLink connection to the FCC,
+    and the HIL GPS and RC link runs as an asyncio UDP transport on the same
+    loop.
+    """
+
+    def __init__(self) -> None:
+        self.drone = mavsdk.System(sysid=141)
+
+        self.telemetry = TelemetryManager(drone=self.drone)
+        self.control = ControlManager(drone=self.drone)
+        self.offboard = OffboardManager(drone=self.drone)
+        self.hil_gps = HILGPSManager()
+
+    async def connect(self) -> None:
+        """
+        Connect the shared Drone object.
+        """
+        logger.debug("FCM: Connecting to the FCC")
+
+        # mavsdk does not support dns
+        await self.drone.connect(system_address="tcp://127.0.0.1:5761")
+
+        logger.success("FCM: Connected to the FCC")
+
+    async def run(self) -> None:
+        await self.connect()
+
+        # the managers wait for the shared connection themselves, and the
+        # HIL GPS link waits for a heartbeat from PX4, so start them together
+        await asyncio.gather(
+            self.telemetry.run_non_blocking(),
+            self.control.run_non_blocking(),
+            self.offboard.run_non_blocking(),
+            self.hil_gps.run_non_blocking(),
+        )
+
+        while True:
+            await asyncio.sleep(1)
+
+
+if __name__ == "__main__":
+    runtime = FCMRuntime()
+    asyncio.run(runtime.run())
@@ -0,0 +1,164 @@
+import copy
+import json
+import os
+import time
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+# Per telemetry stream configuration:
+#   rate_hz: rate requested from PX4 with the mavsdk set_rate_* call, None keeps
+#            the PX4 default
+#   publish_hz: maximum rate samples are republished to MQTT, None publishes
+#               every sample
+#   on_change: only publish samples that differ from the last published one
+#   heartbeat_s: with on_change, republish an unchanged sample after this long
+#   min_hz: rate below which the stream is reported as degraded, None never is
+DEFAULT_STREAM_CONFIG: Dict[str, Dict[str, Any]] = {
+    "battery": {"rate_hz": 1.0, "publish_hz": None, "on_change": False, "heartbeat_s": 1.0, "min_hz": 0.5},
+    "in_air": {"rate_hz": None, "publish_hz": None, "on_change": False, "heartbeat_s": 1.0, "min_hz": None},
+    "armed": {"rate_hz": None, "publish_hz": None, "on_change": False, "heartbeat_s": 1.0, "min_hz": None},
+    "flight_mode": {"rate_hz": None, "publish_hz": None, "on_change": False, "heartbeat_s": 1.0, "min_hz": None},
+    "landed_state": {"rate_hz": None, "publish_hz": None, "on_change": False, "heartbeat_s": 1.0, "min_hz": None},
+    "position_velocity_ned": {"rate_hz": None, "publish_hz": None, "on_change": False, "heartbeat_s": 1.0, "min_hz": 5.0},
+    "position": {"rate_hz": None, "publish_hz": None, "on_change": False, "heartbeat_s": 1.0, "min_hz": 5.0},
+    "home": {"rate_hz": 1.0, "publish_hz": None, "on_change": True, "heartbeat_s": 1.0, "min_hz": None},
+    "attitude_euler": {"rate_hz": None, "publish_hz": 10.0, "on_change": False, "heartbeat_s": 1.0, "min_hz": 5.0},
+    "velocity_ned": {"rate_hz": None, "publish_hz": None, "on_change": False, "heartbeat_s": 1.0, "min_hz": 5.0},
+    "gps_info": {"rate_hz": 1.0, "publish_hz": None, "on_change": True, "heartbeat_s": 1.0, "min_hz": None},
+    # consolidated vehicle state snapshot on avr/fcm/state, only publish_hz
+    # applies, and 0 or None disables it
+    "state": {"rate_hz": None, "publish_hz": 10.0, "on_change": False, "heartbeat_s": 1.0, "min_hz": None},
+    # per stream rate, jitter, and gap stats on avr/fcm/telemetry_stats, only
+    # publish_hz applies, and 0 or None disables it
+    "telemetry_stats": {"rate_hz": None, "publish_hz": 1.0, "on_change": False, "heartbeat_s": 1.0, "min_hz": None},
+}
+
+# highest rate a stream left at its PX4 default rate (rate_hz None) is expected
+# to arrive at, used to size the arrival buffer of its stats
+STREAM_MAX_RATE_HZ = 250.0
+
+# mavsdk telemetry method that sets the PX4 rate of each stream
+SET_RATE_METHODS = {
+    "battery": "set_rate_battery",
+    "in_air": "set_rate_in_air",
+    "landed_state": "set_rate_landed_state",
+    "position_velocity_ned": "set_rate_position_velocity_ned",
+    "position": "set_rate_position",
+    "home": "set_rate_home",
+    "attitude_euler": "set_rate_attitude",
+    "velocity_ned": "set_rate_velocity_ned",
+    "gps_info": "set_rate_gps_info",
+}
+
+
+def load_stream_config(overrides: Optional[Dict[str, Dict[str, Any]]] = None, path: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Returns the stream configuration, starting from the defaults and applying
+    the overrides in a JSON file (by default the one named by the
+    `FCM_STREAM_CONFIG` environment variable, if set) and then the given dict.
+    Overrides only need to contain the streams and keys that change.
+    """
+    config = copy.deepcopy(DEFAULT_STREAM_CONFIG)
+
+    path = path or os.environ.get("FCM_STREAM_CONFIG")
+    layers = []
+    if path:
+        with open(path) as fp:
+            layers.append(json.load(fp))
+    if overrides:
+        layers.append(overrides)
+
+    for layer in layers:
+        for stream, values in layer.items():
+            if stream not in config:
+                raise ValueError(f"Unknown telemetry stream '{stream}'")
+            config[stream].update(values)
+
+    return config
+
+
+class PublishGate:
+    """
+    Decides which samples of a stream get published to a topic, applying the
+    publish rate limit and publish-on-change with a heartbeat.
+    """
+
+    def __init__(self, publish_hz: Optional[float] = None, on_change: bool = False, heartbeat_s: float = 1.0, **kwargs) -> None:
+        self.period = 1 / publish_hz if publish_hz else 0.0
+        self.on_change = on_change
+        self.heartbeat_s = heartbeat_s
+
+        self.last_payload: Any = None
+        self.last_publish = -float("inf")
+        self.published = 0
+        self.suppressed = 0
+
+    def should_publish(self, payload: Any, now: Optional[float] = None) -> bool:
+        """
+        Returns whether a sample should be published, and records it if so.
+        """
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self.last_publish
+
+        publish = elapsed >= self.period
+        if publish and self.on_change and payload == self.last_payload:
+            publish = elapsed >= self.heartbeat_s
+
+        if publish:
+            self.last_payload = payload
+            self.last_publish = now
+            self.published += 1
+        else:
+            self.suppressed += 1
+
+        return publish
+
+
+class StreamStats:
+    """
+    Arrival statistics of a telemetry stream. Arrival times are kept in a fixed
+    size ring buffer, sized to hold a full window at 1.5x `max_rate_hz` so
+    that the rate is not capped by the buffer, and the rate, jitter (standard deviation of the time
+    between samples), and maximum gap are computed over the last `window_s`
+    seconds. The gap includes the time since the last sample, so a stream that
+    stops entirely shows up as well.
+    """
+
+    def __init__(self, window_s: float = 5.0, max_rate_hz: float = STREAM_MAX_RATE_HZ) -> None:
+        self.window_s = window_s
+        self.arrivals = np.full(int(window_s * max_rate_hz * 1.5), np.nan)
+        self.index = 0
+        self.count = 0
+        self.created = time.monotonic()
+
+    def record(self, now: Optional[float] = None) -> None:
+        """
+        Records the arrival of a sample.
+        """
+        self.arrivals[self.index] = time.monotonic() if now is None else now
+        self.index = (self.index + 1) % len(self.arrivals)
+        self.count += 1
+
+    def stats(self, now: Optional[float] = None) -> Dict[str, Optional[float]]:
+        """
+        Returns the total sample count, and the rate (Hz), jitter and max gap
+        (seconds) over the window.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        arrivals = np.sort(self.arrivals[self.arrivals >= now - self.window_s])
+        intervals = np.diff(np.append(arrivals, now))
+
+        # streams younger than the window are measured over their lifetime
+        window = min(self.window_s, now - self.created)
+        last = self.arrivals[(self.index - 1) % len(self.arrivals)]
+
+        return {
+            "count": self.count,
+            "rate_hz": round(len(arrivals) / window, 3) if window > 0 else None,
+            "jitter_s": round(float(np.std(intervals[:-1])), 4) if len(intervals) > 2 else None,
+            "max_gap_s": round(float(intervals.max()), 4) if len(arrivals) else (round(float(now - last), 4) if self.count else None),
+        }
@@ -1,6 +1,7 @@
 import asyncio
 import math
 import time
+from typing import Any, Dict, Optional, Set, Tuple
 
 import mavsdk
 from bell.avr.mqtt.payloads import (
@@ -14,17 +15,54 @@ from bell.avr.mqtt.payloads import (
     AvrFcmVelocityPayload,
 )
 from bell.avr.utils.decorators import async_try_except
-from bell.avr.utils.timing import rate_limit
 from fcc_mqtt import FCMMQTTModule
+from fcc_streams import (
+    SET_RATE_METHODS,
+    STREAM_MAX_RATE_HZ,
+    PublishGate,
+    StreamStats,
+    load_stream_config,
+)
 from loguru import logger
+from mavsdk.telemetry import TelemetryError
 
 
 class TelemetryManager(FCMMQTTModule):
-    def __init__(self) -> None:
+    def __init__(self, drone: Optional[mavsdk.System] = None, stream_config: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
         super().__init__()
 
-        # mavlink stuff
-        self.drone = mavsdk.System(sysid=142)
+        # mavlink stuff. A drone that is passed in is shared with the other
+        # managers, and is connected by its owner (see fcc_runtime.py)
+        self.owns_drone = drone is None
+        self.drone = drone or mavsdk.System(sysid=142)
+
+        # per stream PX4 rates and MQTT publish decimation, see fcc_streams.py
+        self.streams = load_stream_config(stream_config)
+        self.gates: Dict[Tuple[str, str], PublishGate] = {}
+        # arrival stats of every telemetry stream, created once connected
+        self.stream_stats: Dict[str, StreamStats] = {}
+        # streams currently below their min_hz floor
+        self.degraded_streams: Set[str] = set()
+
+        # latest value of every telemetry stream, published together as one
+        # snapshot on avr/fcm/state
+        self.state: Dict[str, Any] = {
+            "connected": False,
+            "armed": False,
+            "mode": "UNKNOWN",
+            "offboard": False,
+            "in_air": False,
+            "landed_state": "UNKNOWN",
+            "battery": None,
+            "location_local": None,
+            "location_global": None,
+            "location_home": None,
+            "attitude_euler": None,
+            "velocity": None,
+            "gps_info": None,
+        }
+        # wall clock time each state field was last updated
+        self.state_updated: Dict[str, float] = {}
 
         # current state of offboard mode, acts as a backup for PX4
         self.offboard_enabled = False
@@ -45,8 +83,15 @@ class TelemetryManager(FCMMQTTModule):
         # import logging
         # logging.basicConfig(level=logging.DEBUG)
 
-        # mavsdk does not support dns
-        await self.drone.connect(system_address="tcp://127.0.0.1:5761")
+        if self.owns_drone:
+            # mavsdk does not support dns
+            await self.drone.connect(system_address="tcp://127.0.0.1:5761")
+        else:
+            # reconnecting a shared drone would restart mavsdk_server from under
+            # the other managers, so just wait for the link to come up
+            async for connection_status in self.drone.core.connection_state():
+                if connection_status.is_connected:
+                    break
 
         logger.success("Telemetry: Connected to the FCC")
         self._publish_event("fcc_telemetry_connected_event")
@@ -60,10 +105,15 @@ class TelemetryManager(FCMMQTTModule):
 
         # connect to the fcc
         await self.connect()
+        await self.set_stream_rates()
+
+        self.stream_stats = {stream: StreamStats(max_rate_hz=config["rate_hz"] or STREAM_MAX_RATE_HZ) for stream, config in self.streams.items() if stream not in ("state", "telemetry_stats")}
 
         # start tasks
         return asyncio.gather(
             self.telemetry_tasks(),
+            self.state_publisher(),
+            self.stats_publisher(),
         )
 
     async def run(self) -> asyncio.Future:
@@ -71,6 +121,109 @@ class TelemetryManager(FCMMQTTModule):
         while True:
             await asyncio.sleep(1)
 
+    async def set_stream_rates(self) -> None:
+        """
+        Requests the configured rate of each telemetry stream from PX4.
+        """
+        for stream, config in self.streams.items():
+            if config["rate_hz"] is None or stream not in SET_RATE_METHODS:
+                continue
+
+            try:
+                await getattr(self.drone.telemetry, SET_RATE_METHODS[stream])(config["rate_hz"])
+                logger.debug(f"Telemetry: set {stream} rate to {config['rate_hz']} Hz")
+            except TelemetryError as e:
+                logger.warning(f"Telemetry: could not set {stream} rate: {e._result.result_str}")
+
+    def publish_stream(self, stream: str, topic: str, payload: Any) -> None:
+        """
+        Publishes a telemetry sample if the publish settings of its stream allow it.
+        """
+        key = (stream, topic)
+        if key not in self.gates:
+            self.gates[key] = PublishGate(**self.streams[stream])
+
+        if self.gates[key].should_publish(payload):
+            self.send_message(topic, payload)  # type: ignore
+
+    def record_sample(self, stream: str) -> None:
+        """
+        Records the arrival of a telemetry sample for the stream health stats.
+        """
+        stats = self.stream_stats.get(stream)
+        if stats is not None:
+            stats.record()
+
+    def update_state(self, field: str, value: Any) -> None:
+        """
+        Updates a field of the vehicle state snapshot.
+        """
+        self.state[field] = value
+        self.state_updated[field] = time.time()
+
+    @async_try_except()
+    async def state_publisher(self) -> None:
+        """
+        Publishes the vehicle state snapshot at the rate of the "state" stream.
+        Every telemetry loop runs on this event loop, so the snapshot is
+        consistent without any locking.
+        """
+        publish_hz = self.streams["state"]["publish_hz"]
+        if not publish_hz:
+            return
+
+        logger.debug("state publisher loop started")
+        while True:
+            await asyncio.sleep(1 / publish_hz)
+
+            now = time.time()
+            snapshot = dict(self.state)
+            snapshot["timestamp"] = now
+            # seconds since each field was last updated
+            snapshot["age"] = {field: round(now - updated, 3) for field, updated in self.state_updated.items()}
+
+            self.send_message("avr/fcm/state", snapshot)  # type: ignore
+
+    @async_try_except()
+    async def stats_publisher(self) -> None:
+        """
+        Publishes the rate, jitter, and max gap of every telemetry stream at the
+        rate of the "telemetry_stats" stream, and publishes an event when a
+        stream drops below its min_hz floor and when it recovers.
+        """
+        publish_hz = self.streams["telemetry_stats"]["publish_hz"]
+        if not publish_hz:
+            return
+
+        logger.debug("telemetry stats loop started")
+        while True:
+            await asyncio.sleep(1 / publish_hz)
+
+            now = time.monotonic()
+            stats = {}
+            for stream, stream_stats in self.stream_stats.items():
+                stats[stream] = stream_stats.stats(now)
+                min_hz = self.streams[stream]["min_hz"]
+
+                # give the stream a full window before judging its rate
+                if min_hz is None or now - stream_stats.created < stream_stats.window_s:
+                    continue
+
+                degraded = stats[stream]["rate_hz"] < min_hz
+                if degraded and stream not in self.degraded_streams:
+                    logger.warning(f"Telemetry: {stream} is at {stats[stream]['rate_hz']} Hz, below {min_hz} Hz")
+                    self.degraded_streams.add(stream)
+                    self._publish_event("telemetry_stream_degraded_event", stream)
+                elif not degraded and stream in self.degraded_streams:
+                    logger.info(f"Telemetry: {stream} recovered to {stats[stream]['rate_hz']} Hz")
+                    self.degraded_streams.discard(stream)
+                    self._publish_event("telemetry_stream_recovered_event", stream)
+
+            self.send_message(  # type: ignore
+                "avr/fcm/telemetry_stats",
+                {"timestamp": time.time(), "streams": stats, "degraded": sorted(self.degraded_streams)},
+            )
+
     # region ###################  T E L E M E T R Y ###########################
 
     async def telemetry_tasks(self) -> asyncio.Future:
@@ -104,6 +257,7 @@ class TelemetryManager(FCMMQTTModule):
         logger.debug("connected_status loop started")
         async for connection_status in self.drone.core.connection_state():
             connected = connection_status.is_connected
+            self.update_state("connected", connected)
             now = time.time()
             should_update = False
 
@@ -129,12 +283,13 @@ class TelemetryManager(FCMMQTTModule):
         """
         logger.debug("battery_telemetry loop started")
         async for battery in self.drone.telemetry.battery():
-
+            self.record_sample("battery")
             update = AvrFcmBatteryPayload(
                 voltage=battery.voltage_v,
                 soc=battery.remaining_percent * 100.0,
             )
-            self.send_message("avr/fcm/battery", update)  # type: ignore
+            self.update_state("battery", update)
+            self.publish_stream("battery", "avr/fcm/battery", update)
 
     @async_try_except()
     async def in_air_telemetry(self) -> None:
@@ -143,7 +298,9 @@ class TelemetryManager(FCMMQTTModule):
         """
         logger.debug("in_air loop started")
         async for in_air in self.drone.telemetry.in_air():
+            self.record_sample("in_air")
             self.in_air = in_air
+            self.update_state("in_air", in_air)
 
     @async_try_except()
     async def is_armed_telemetry(self) -> None:
@@ -154,7 +311,7 @@ class TelemetryManager(FCMMQTTModule):
 
         logger.debug("is_armed loop started")
         async for armed in self.drone.telemetry.armed():
-
+            self.record_sample("armed")
             # if the arming status is different than last time
             if armed != was_armed:
                 if armed:
@@ -163,13 +320,14 @@ class TelemetryManager(FCMMQTTModule):
                     self._publish_event("fcc_disarmed_event")
             was_armed = armed
             self.is_armed = armed
+            self.update_state("armed", armed)
 
             update = AvrFcmStatusPayload(
                 armed=armed,
                 mode=str(self.fcc_mode),
             )
 
-            self.send_message("avr/fcm/status", update)  # type: ignore
+            self.publish_stream("armed", "avr/fcm/status", update)
 
     @async_try_except()
     async def landed_state_telemetry(self) -> None:
@@ -180,7 +338,9 @@ class TelemetryManager(FCMMQTTModule):
         previous_state = "UNKNOWN"
 
         async for state in self.drone.telemetry.landed_state():
+            self.record_sample("landed_state")
             mode = str(state)
+            self.update_state("landed_state", mode)
             # if we have a state change
             if mode != previous_state:
                 if mode == "IN_AIR":
@@ -223,13 +383,13 @@ class TelemetryManager(FCMMQTTModule):
         logger.debug("flight_mode_telemetry loop started")
 
         async for mode in self.drone.telemetry.flight_mode():
-
+            self.record_sample("flight_mode")
             update = AvrFcmStatusPayload(
                 mode=str(mode),
                 armed=self.is_armed,
             )
 
-            self.send_message("avr/fcm/status", update)  # type: ignore
+            self.publish_stream("flight_mode", "avr/fcm/status", update)
 
             if mode != fcc_mode:
                 try:
@@ -239,6 +399,9 @@ class TelemetryManager(FCMMQTTModule):
                     logger.debug(f"Got mode {mode} not in mode map")
             fcc_mode = mode
             self.fcc_mode = mode
+            self.offboard_enabled = str(mode) == "OFFBOARD"
+            self.update_state("mode", str(mode))
+            self.update_state("offboard", self.offboard_enabled)
 
     @async_try_except()
     async def position_ned_telemetry(self) -> None:
@@ -247,14 +410,15 @@ class TelemetryManager(FCMMQTTModule):
         """
         logger.debug("position_ned telemetry loop started")
         async for position in self.drone.telemetry.position_velocity_ned():
-
+            self.record_sample("position_velocity_ned")
             n = position.position.north_m
             e = position.position.east_m
             d = position.position.down_m
 
             update = AvrFcmLocationLocalPayload(dX=n, dY=e, dZ=d)
 
-            self.send_message("avr/fcm/location/local", update)  # type: ignore
+            self.update_state("location_local", update)
+            self.publish_stream("position_velocity_ned", "avr/fcm/location/local", update)
 
     @async_try_except()
     async def position_lla_telemetry(self) -> None:
@@ -263,6 +427,7 @@ class TelemetryManager(FCMMQTTModule):
         """
         logger.debug("position_lla telemetry loop started")
         async for position in self.drone.telemetry.position():
+            self.record_sample("position")
             update = AvrFcmLocationGlobalPayload(
                 lat=position.latitude_deg,
                 lon=position.longitude_deg,
@@ -270,7 +435,7 @@ class TelemetryManager(FCMMQTTModule):
                 hdg=self.heading,
             )
 
-            self.send_message("avr/fcm/location/global", update)  # type: ignore
+            self.publish_stream("position", "avr/fcm/location/global", update)
 
             # TODO - this is an interim solution until the AvrFcmLocationHomePayload object can be updated
             update = {}
@@ -278,7 +443,8 @@ class TelemetryManager(FCMMQTTModule):
             update["lon"] = position.longitude_deg
             update["rel_alt"] = position.relative_altitude_m
             update["abs_alt"] = position.absolute_altitude_m
-            self.send_message("avr/fcm/location/global_full", update)  # type: ignore
+            self.update_state("location_global", dict(update, hdg=self.heading))
+            self.publish_stream("position", "avr/fcm/location/global_full", update)
 
     @async_try_except()
     async def home_lla_telemetry(self) -> None:
@@ -287,12 +453,13 @@ class TelemetryManager(FCMMQTTModule):
         """
         logger.debug("home_lla telemetry loop started")
         async for home_position in self.drone.telemetry.home():
+            self.record_sample("home")
             update = AvrFcmLocationHomePayload(
                 lat=home_position.latitude_deg,
                 lon=home_position.longitude_deg,
                 alt=home_position.relative_altitude_m,
             )
-            self.send_message("avr/fcm/location/home", update)  # type: ignore
+            self.publish_stream("home", "avr/fcm/location/home", update)
 
             # TODO - this is an interim solution until the AvrFcmLocationHomePayload object can be updated
             update = {}
@@ -300,7 +467,8 @@ class TelemetryManager(FCMMQTTModule):
             update["lon"] = home_position.longitude_deg
             update["rel_alt"] = home_position.relative_altitude_m
             update["abs_alt"] = home_position.absolute_altitude_m
-            self.send_message("avr/fcm/location/home_full", update)  # type: ignore
+            self.update_state("location_home", update)
+            self.publish_stream("home", "avr/fcm/location/home_full", update)
 
     @async_try_except()
     async def attitude_euler_telemetry(self) -> None:
@@ -310,6 +478,7 @@ class TelemetryManager(FCMMQTTModule):
 
         logger.debug("attitude_euler telemetry loop started")
         async for attitude in self.drone.telemetry.attitude_euler():
+            self.record_sample("attitude_euler")
             psi = attitude.roll_deg
             theta = attitude.pitch_deg
             phi = attitude.yaw_deg
@@ -325,11 +494,8 @@ class TelemetryManager(FCMMQTTModule):
 
             self.heading = heading
 
-            # publish telemetry every tenth of a second
-            rate_limit(
-                lambda: self.send_message("avr/fcm/attitude/euler", update),  # type: ignore
-                frequency=10,
-            )
+            self.update_state("attitude_euler", update)
+            self.publish_stream("attitude_euler", "avr/fcm/attitude/euler", update)
 
     @async_try_except()
     async def velocity_ned_telemetry(self) -> None:
@@ -339,13 +505,15 @@ class TelemetryManager(FCMMQTTModule):
 
         logger.debug("velocity_ned telemetry loop started")
         async for velocity in self.drone.telemetry.velocity_ned():
+            self.record_sample("velocity_ned")
             update = AvrFcmVelocityPayload(
                 vX=velocity.north_m_s,
                 vY=velocity.east_m_s,
                 vZ=velocity.down_m_s,
             )
 
-            self.send_message("avr/fcm/velocity", update)  # type: ignore
+            self.update_state("velocity", update)
+            self.publish_stream("velocity_ned", "avr/fcm/velocity", update)
 
     @async_try_except()
     async def gps_info_telemetry(self) -> None:
@@ -354,12 +522,14 @@ class TelemetryManager(FCMMQTTModule):
         """
         logger.debug("gps_info telemetry loop started")
         async for gps_info in self.drone.telemetry.gps_info():
+            self.record_sample("gps_info")
             update = AvrFcmGpsInfoPayload(
                 num_satellites=gps_info.num_satellites,
                 fix_type=str(gps_info.fix_type),
             )
 
-            self.send_message("avr/fcm/gps_info", update)  # type: ignore
+            self.update_state("gps_info", update)
+            self.publish_stream("gps_info", "avr/fcm/gps_info", update)
 
     # endregion ###############################################################
 
@@ -296,6 +296,11 @@ class FusionModule(MQTTModule):
                 d=at_ned["d"],
                 heading=at_heading,
             )
+
+            # extend the AprilTag latency trace with the time fusion acted on it
+            if "trace" in msg:
+                resync["trace"] = dict(msg["trace"], fusion=time.monotonic())  # type: ignore
+
             self.send_message("avr/vio/resync", resync)
 
         self.last_apriltag = now
@@ -126,6 +126,10 @@ class Sandbox(MQTTModule):
         logger.debug(f"State: {self.thermal_state}, Range: {self.target_range}, Step: {self.targeting_step}, Hotspot Flash: {self.flash_leds_on_detection}, Log Data: {self.log_thermal_data}")
 
     def handle_apriltags(self, payload: AvrApriltagsVisiblePayload) -> None:  # This handler is only called when an apriltag is scanned and processed successfully
+        if "trace" in payload:
+            # Echo the latency trace with the time the sandbox got the tags, for the AprilTag latency tracer
+            self.send_message("avr/apriltags/trace", {"trace": dict(payload["trace"], sandbox=time.monotonic())})  # type: ignore
+
         self.cur_apriltag = payload["tags"][0]
         tag_id = payload["tags"][0]["id"]
 
@@ -420,7 +424,7 @@ class Sandbox(MQTTModule):
                 self.add_mission_waypoint("goto", (2.524, 0.509, 3.5), goto_hold_time=1)  # transformer five
                 self.add_mission_waypoint("goto", (LZ["start"][0], LZ["start"][1], 3.5))  # hover above start
                 self.add_mission_waypoint("land", LZ["start"])  # land at start
-                self.upload_and_engage_mission()
+                self.upload_and_engage_mission(optimize=True)
                 self.set_mission_id()
 
                 self.set_thermal_state(1)
@@ -482,13 +486,14 @@ class Sandbox(MQTTModule):
         """Clear the mission_waypoints list"""
         self.mission_waypoints = []
 
-    def upload_and_engage_mission(self, delay: float = -1) -> None:
+    def upload_and_engage_mission(self, delay: float = -1, optimize: bool = False) -> None:
         """Upload a mission to the flight controller, mission waypoints are represented in the self.mission_waypoints list.
 
         Args:
             delay (float, optional): Delay in seconds between uploading the mission and starting the mission. Negative or no delay will cause the mission to start as soon as the upload completes.
+            optimize (bool, optional): Let the FCM reorder the `goto` waypoints for the shortest flight time. The first waypoint, `land` waypoints, and the `goto` right before a `land` keep their place. Defaults to False
         """
-        self.send_action("upload_mission", {"waypoints": self.mission_waypoints})
+        self.send_action("upload_mission", {"waypoints": self.mission_waypoints, "optimize": optimize})
         self.clear_mission_waypoints()
         # If delay is left blank the mission should start as soon as the mission upload completes
         if delay < 0: